@@ -25,15 +25,60 @@
 # Usage        : deserializer.py input_plist_path
 #                Output will be saved in same location with _deserialised.plist 
 #                appended to filename.
+#                deserializer.py -r [-w WORKERS] input_folder
+#                Recursively processes every NSKeyedArchive found under the
+#                folder, whatever its extension, using a pool of processes.
+#                Files are sniffed first (header, trailer and top level object
+#                only), and anything that is not an NSKeyedArchive is skipped.
+#                deserializer.py -r --jsonl out.jsonl input_folder
+#                deserializer.py -r --sqlite out.db input_folder
+#                All results go to a single file instead of beside each input.
+#                deserializer.py -r --cache CACHE_FOLDER input_folder
+#                Deserialized results are cached (by file hash) in the folder
+#                and reused when the same file is seen again. Only this needs
+#                cache_index.py from the root folder of this repo (next to 
+#                this script or one folder up).
 # Requirements : 
 #                Python3.x
 #                nska_deserialize (Get it with pip3 install nska_deserialize)
 #
 # Note: This will not work with python 2.xx
 
+import hashlib
+import importlib.util
+import json
 import nska_deserialize as nd
 import os
+import queue
+import shutil
+import sqlite3
+import struct
 import sys
+import tempfile
+import threading
+
+from concurrent.futures import ProcessPoolExecutor
+from json.encoder import encode_basestring_ascii
+
+cache_index = None # imported by load_cache_index(), only --cache needs it
+
+def load_cache_index():
+    '''Imports cache_index on first use, from the path or else from the root
+       of this repo. Raises ImportError if it is not found.'''
+    global cache_index
+    if cache_index is None:
+        try:
+            import cache_index as module
+        except ImportError:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache_index.py')
+            if not os.path.isfile(path):
+                raise
+            spec = importlib.util.spec_from_file_location('cache_index', path)
+            module = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(module)
+        cache_index = module
+
+DEFAULT_CACHE_SIZE_MB = 512
 
 usage = rf"""
 Deserializer version {nd.get_version()}  (c) Yogesh Khatri 2018-2024
@@ -41,9 +86,11 @@ This tool converts an NSKeyedArchive plist into a normal deserialized one
 using the nska_deserialize library: 
   https://github.com/ydkhatri/nska_deserialize
 
-  Usage  : deserializer.exe [-j] input_plist_path
+  Usage  : deserializer.exe [-j] [-r] [-w WORKERS] [--jsonl OUT | --sqlite OUT] 
+                           [--cache FOLDER [--cache-size MB]] input_plist_path
   Example: deserializer.exe C:\test\com.apple.preview.sfl2
            deserializer.exe -j  C:\test\screentime.plist
+           deserializer.exe -r  C:\Users\jdoe
 
 The -j option will also create a json file as output.
 If successful, the resulting plist or json file will be created in the same folder
@@ -52,37 +99,488 @@ and will have _deserialized appended to its name.
 If input path is a folder, this will attempt to deserialize all .plist file 
 found in that folder (not recursive). Won't process plists without the extension.
 
+The -r option processes the folder recursively instead, and all files in it
+regardless of extension (.sfl2, .sfl3, none..). Each file is quickly checked
+and only NSKeyedArchives are deserialized, in parallel using WORKERS processes
+(default is number of cpus).
+
+The --jsonl and --sqlite options write every result into the single OUT file 
+(one line or one row per input with source, sha256, data and error) instead 
+of creating _deserialized files next to each input. Data is the json output.
+Large results are passed on through local temporary files, and copied into a
+JSONL in chunks. An SQLite row holds the whole json, so there each one is read
+into memory (one at a time) when inserted.
+
+The --cache option keeps deserialized results in FOLDER (as binary plists),
+keyed by the file's sha256 and library version, so files seen in earlier runs 
+(or duplicates on other machines) are not parsed again. Least recently used 
+entries are removed when the cache grows over MB (default {DEFAULT_CACHE_SIZE_MB}).
+
 """
 
-def main():
-    create_json = False
-    create_plist = True
+# These are all possible errors from libraries imported
+DESERIALIZE_ERRORS = (nd.DeserializeError, 
+                      nd.biplist.NotBinaryPlistException, 
+                      nd.biplist.InvalidPlistException,
+                      nd.plistlib.InvalidFileException,
+                      nd.ccl_bplist.BplistError, 
+                      ValueError, 
+                      TypeError, OSError, OverflowError)
 
-    if len(sys.argv) == 1:
-        print(usage)
-        return
-    
-    elif len(sys.argv) == 2:
-        input_path = sys.argv[1]
+XML_SNIFF_SIZE = 0x10000 # $archiver is usually the first key, so near the start
+SINK_QUEUE_SIZE = 256     # results held in memory while the writer catches up
+SINK_BUFFER_SIZE = 0x100000
+SINK_COMMIT_INTERVAL = 500
+SINK_INLINE_SIZE = 0x40000 # larger json results go through a temporary file
+JSON_FLUSH_PARTS = 4096   # pending json fragments before a write to the output
 
-    elif len(sys.argv) > 2:
-        if sys.argv[1].lower() == '-h':
-            print(usage)
-            return
-        elif sys.argv[1].lower() == '-j':
-            create_json = True
-            input_path = sys.argv[2]
-        elif os.path.exists(sys.argv[1]):
-            input_path = sys.argv[1]
+def _read_bplist_object_header(f, offset):
+    '''Returns (type, count) of the binary plist object at offset, leaves f
+       positioned after the header.'''
+    f.seek(offset)
+    marker = f.read(1)[0]
+    count = marker & 0xF
+    if count == 0xF:
+        int_marker = f.read(1)[0]
+        if int_marker >> 4 != 1:
+            raise ValueError('Bad count')
+        count = int.from_bytes(f.read(1 << (int_marker & 0xF)), 'big')
+    return marker >> 4, count
+
+def _is_binary_nska(f, file_size):
+    '''Reads trailer and top level object of a binary plist, returns True if it has
+       $archiver = NSKeyedArchiver at top, or is a data blob (may hold an archive).'''
+    if file_size < 40:
+        return False
+    f.seek(file_size - 32)
+    offset_size, ref_size, num_objects, top_object, table_offset = struct.unpack('>6xBBQQQ', f.read(32))
+    if offset_size == 0 or ref_size == 0 or top_object >= num_objects or \
+       table_offset + num_objects * offset_size > file_size:
+        return False
+
+    def object_offset(ref):
+        f.seek(table_offset + ref * offset_size)
+        return int.from_bytes(f.read(offset_size), 'big')
+
+    def read_string(ref):
+        obj_type, count = _read_bplist_object_header(f, object_offset(ref))
+        if obj_type == 5:
+            return f.read(count).decode('ascii', 'replace')
+        elif obj_type == 6:
+            return f.read(count * 2).decode('utf-16-be', 'replace')
+        return None
+
+    obj_type, count = _read_bplist_object_header(f, object_offset(top_object))
+    if obj_type == 4: # data
+        return True
+    if obj_type != 0xD or count > 1024: # NSKA has a small top level dict
+        return False
+    refs = f.read(2 * count * ref_size)
+    if len(refs) < 2 * count * ref_size:
+        return False
+    for index in range(count):
+        key_ref = int.from_bytes(refs[index * ref_size : (index + 1) * ref_size], 'big')
+        if read_string(key_ref) == '$archiver':
+            value_ref = int.from_bytes(refs[(count + index) * ref_size : (count + index + 1) * ref_size], 'big')
+            return read_string(value_ref) == 'NSKeyedArchiver'
+    return False
+
+def is_nska_candidate(path):
+    '''Cheap check if file at path can be an NSKeyedArchive, binary or xml, 
+       without parsing the whole plist. Returns True or False'''
+    try:
+        with open(path, 'rb') as f:
+            header = f.read(8)
+            if header == b'bplist00':
+                return _is_binary_nska(f, os.fstat(f.fileno()).st_size)
+            if header.lstrip()[0:1] == b'<':
+                data = header + f.read(XML_SNIFF_SIZE)
+                return data.find(b'<plist') >= 0 and data.find(b'NSKeyedArchiver') >= 0
+    except (OSError, ValueError, IndexError, struct.error):
+        pass
+    return False
+
+def find_nska_files(folder):
+    '''Walks folder recursively, returns (list of NSKA candidate paths, number of files seen)'''
+    candidates = []
+    num_files = 0
+    for root, _, files in os.walk(folder):
+        for name in files:
+            num_files += 1
+            path = os.path.join(root, name)
+            if is_nska_candidate(path):
+                candidates.append(path)
+    candidates.sort()
+    return candidates, num_files
+
+def load_deserialized_plist(data, cache_folder=None):
+    '''Deserializes data (file contents), reusing the result cached in cache_folder
+       if there is one, else storing it there. Returns (deserialized_plist, info)
+       where info is a dict with 'sha256', and also 'cache_key', 'cache_hit' and 
+       'size' if cache is used. Raises DESERIALIZE_ERRORS from the library.
+    '''
+    sha256 = hashlib.sha256(data).hexdigest()
+    info = {'sha256': sha256}
+    if cache_folder:
+        load_cache_index()
+        key = sha256 + '_' + nd.get_version()
+        object_path = cache_index.get_cache_object_path(cache_folder, key)
+        info['cache_key'] = key
+        try:
+            with open(object_path, 'rb') as f:
+                deserialized_plist = nd.plistlib.load(f) # only data, never code, is loaded from cache
+            info['cache_hit'] = True
+            info['size'] = os.path.getsize(object_path)
+            return deserialized_plist, info
+        except Exception: # missing or damaged entry, deserialize again
+            pass
+    deserialized_plist = nd.deserialize_plist_from_string(data, True)
+    if cache_folder:
+        temp_path = object_path + '.tmp' + str(os.getpid())
+        try:
+            # Key order is kept, and results that don't come back identical 
+            # from a plist (types a plist can't hold) are not cached.
+            plist_data = nd.plistlib.dumps(deserialized_plist, fmt=nd.plistlib.FMT_BINARY, sort_keys=False)
+            if nd.plistlib.loads(plist_data) != deserialized_plist:
+                raise ValueError('Result changes when stored as plist')
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            with open(temp_path, 'wb') as f:
+                f.write(plist_data)
+            os.replace(temp_path, object_path)
+            info['cache_hit'] = False
+            info['size'] = len(plist_data)
+        except (OSError, ValueError, TypeError, OverflowError, AttributeError, RecursionError):
+            try: # not cached, result is still fine
+                os.remove(temp_path)
+            except OSError:
+                pass
+    return deserialized_plist, info
+
+def deserialize_file(path, create_json, create_plist, cache_folder=None):
+    '''Deserializes the file at path and writes outputs next to it. 
+       Returns (error message or '' if successful, list of output paths, info)
+       where info is as returned by load_deserialized_plist()'''
+    outputs = []
+    info = {}
+    with open(path, 'rb') as f:
+        data = f.read()
+    try:
+        deserialized_plist, info = load_deserialized_plist(data, cache_folder) # Get Deserialized plist
+    except DESERIALIZE_ERRORS as ex:
+        return 'Had exception: ' + str(ex), outputs, info
+
+    if deserialized_plist:
+        output_path_plist = path + '_deserialized.plist'
+        output_path_json  = path + '_deserialized.json'
+        try:
+            if create_json:
+                write_plist_to_json_file(deserialized_plist, output_path_json)
+                outputs.append(output_path_json)
+            if create_plist:
+                nd.write_plist_to_file(deserialized_plist, output_path_plist)
+                outputs.append(output_path_plist)
+        except (OSError, ValueError, TypeError, OverflowError) as ex:
+            return 'Failed to write output: ' + str(ex), outputs, info
+    return '', outputs, info
+
+def _get_json_key(key):
+    '''Returns dict key as encoded json string, converted like json.dump does'''
+    if isinstance(key, str):
+        pass
+    elif isinstance(key, bool):
+        key = 'true' if key else 'false'
+    elif key is None:
+        key = 'null'
+    elif isinstance(key, (int, float)):
+        key = json.dumps(key)
+    else:
+        raise TypeError(f'keys must be str, int, float, bool or None, not {key.__class__.__name__}')
+    return encode_basestring_ascii(key)
+
+def write_json_stream(deserialized_plist, out_file):
+    '''Writes the deserialized plist as json to out_file while walking the tree,
+       without building a json ready copy of it in memory first. Output is 
+       identical to nd.write_plist_to_json_file, bytes are written as hex and 
+       all other values that are not a list or dict (int, date, UID..) as strings.
+    '''
+    end = object()
+    parts = []
+    stack = []
+
+    def open_container(obj):
+        if isinstance(obj, dict):
+            parts.append('{')
+            stack.append((iter(obj.items()), True))
         else:
-            print(f"Error, unrecognized input {sys.argv[1]}")
+            parts.append('[')
+            stack.append((iter(obj), False))
+
+    open_container(deserialized_plist)
+    first = True
+    while stack:
+        items, is_dict = stack[-1]
+        item = next(items, end)
+        if item is end:
+            stack.pop()
+            parts.append('}' if is_dict else ']')
+            first = False
+            continue
+        if not first:
+            parts.append(', ')
+        first = False
+        if is_dict:
+            key, value = item
+            parts.append(_get_json_key(key))
+            parts.append(': ')
+        else:
+            value = item
+        if isinstance(value, (list, dict)):
+            open_container(value)
+            first = True
+        elif isinstance(value, bytes):
+            parts.append('"' + value.hex() + '"')
+        else:
+            parts.append(encode_basestring_ascii(str(value)))
+        if len(parts) >= JSON_FLUSH_PARTS:
+            out_file.write(''.join(parts))
+            parts.clear()
+    out_file.write(''.join(parts))
+
+def write_plist_to_json_file(deserialized_plist, output_path):
+    '''Streaming replacement for nd.write_plist_to_json_file, same output'''
+    with open(output_path, 'w') as out_file:
+        write_json_stream(deserialized_plist, out_file)
+
+def get_utf8_text(text):
+    '''Returns source paths and error messages as the sink and console can write 
+       them, undecodable bytes in names are escaped (\\xNN)'''
+    try:
+        text.encode('utf-8')
+        return text
+    except UnicodeEncodeError:
+        try:
+            return os.fsencode(text).decode('utf-8', 'backslashreplace')
+        except UnicodeError:
+            return text.encode('utf-8', 'backslashreplace').decode('utf-8')
+
+class JsonSpool:
+    '''Output for write_json_stream() that keeps the json in memory, and moves it
+       to a new file in temp_folder once it grows over SINK_INLINE_SIZE'''
+    def __init__(self, temp_folder):
+        self.temp_folder = temp_folder
+        self.parts = []
+        self.size = 0
+        self.file = None
+
+    def write(self, text):
+        if self.file:
+            self.file.write(text)
             return
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size > SINK_INLINE_SIZE:
+            self.file = tempfile.NamedTemporaryFile('w', dir=self.temp_folder, suffix='.json', delete=False)
+            self.file.write(''.join(self.parts))
+            self.parts = []
 
-    if not os.path.exists(input_path):
-        print(f"Error, input_file \"{input_path}\" does not exist! Check file path!")
-        print(usage)
-        return
-    
+    def close(self):
+        '''Returns (json text, None) or (None, path of temporary file)'''
+        if self.file:
+            self.file.close()
+            return None, self.file.name
+        return ''.join(self.parts), None
+
+    def discard(self):
+        if self.file:
+            self.file.close()
+            os.remove(self.file.name)
+
+def get_json_result(deserialized_plist, temp_folder):
+    '''Returns (json text, None) for the deserialized plist, same as what 
+       write_plist_to_json_file writes, or (None, path) if it is large and 
+       was written to a file in temp_folder instead'''
+    spool = JsonSpool(temp_folder)
+    try:
+        write_json_stream(deserialized_plist, spool)
+    except BaseException:
+        spool.discard()
+        raise
+    return spool.close()
+
+def deserialize_to_record(job):
+    '''Process pool worker for the single output file mode, job is (path, cache_folder,
+       temp_folder), nothing is written beside the input. Returns (path, sha256, 
+       json text, path of json file in temp_folder, error, info) where json text 
+       and path are None unless used (see get_json_result) and info is as 
+       returned by load_deserialized_plist()'''
+    path, cache_folder, temp_folder = job
+    info = {}
+    file_data = None
+    try:
+        with open(path, 'rb') as f:
+            file_data = f.read()
+        deserialized_plist, info = load_deserialized_plist(file_data, cache_folder)
+        data, data_path = get_json_result(deserialized_plist, temp_folder)
+        return path, info['sha256'], data, data_path, '', info
+    except DESERIALIZE_ERRORS as ex:
+        error = 'Had exception: ' + str(ex)
+    except Exception as ex: # anything else from the libraries should not stop the batch
+        error = f'Had exception: {type(ex).__name__} {str(ex)}'
+    sha256 = info.get('sha256', '')
+    if not sha256 and file_data is not None: # failed before load_deserialized_plist hashed it
+        sha256 = hashlib.sha256(file_data).hexdigest()
+    return path, sha256, None, None, error, info
+
+class ResultSink(threading.Thread):
+    '''Writes (source, sha256, data, data_path, error) records to one JSONL file
+       or SQLite db from a background thread, so collecting results never waits
+       on disk. Data is json text (or None), embedded as is in JSONL lines. Large
+       results come as data_path instead, a json file written by a worker into 
+       temp_folder (a local temporary folder), which is copied in chunks and then
+       deleted.'''
+    def __init__(self, output_path, use_sqlite):
+        super().__init__(daemon=True)
+        self.output_path = output_path
+        self.use_sqlite = use_sqlite
+        self.temp_folder = tempfile.mkdtemp(prefix='deserializer_')
+        self.queue = queue.Queue(SINK_QUEUE_SIZE)
+        self.count = 0
+        self.failed = 0
+        self.error = None
+        self.conn = None
+        self.file = None
+
+    def put(self, source, sha256, data, data_path, error):
+        self.queue.put((source, sha256, data, data_path, error))
+
+    def close(self):
+        '''Waits for all queued records to be written. Raises OSError or 
+           sqlite3.Error if the output could not be opened or closed, records
+           that could not be written are logged and counted in failed.'''
+        self.queue.put(None)
+        self.join()
+        if self.error:
+            raise self.error
+
+    def run(self):
+        try:
+            self._open()
+        except (OSError, sqlite3.Error) as ex:
+            self.error = ex
+            while self.queue.get() is not None: # drain so producer does not block
+                pass
+            shutil.rmtree(self.temp_folder, ignore_errors=True)
+            return
+        try:
+            while True:
+                record = self.queue.get()
+                if record is None:
+                    break
+                try:
+                    self._write(record)
+                    self.count += 1
+                except Exception as ex: # log it, one bad record must not stop the others
+                    self.failed += 1
+                    print(f"Error writing result for {get_utf8_text(record[0])} - {get_utf8_text(str(ex))}")
+                finally:
+                    if record[3]:
+                        try:
+                            os.remove(record[3])
+                        except OSError:
+                            pass
+        finally:
+            try:
+                self._close()
+            except (OSError, sqlite3.Error) as ex:
+                self.error = ex
+            shutil.rmtree(self.temp_folder, ignore_errors=True)
+
+    def _open(self):
+        if self.use_sqlite:
+            self.conn = sqlite3.connect(self.output_path)
+            self.conn.execute('CREATE TABLE IF NOT EXISTS results (source TEXT, sha256 TEXT, data TEXT, error TEXT)')
+        else:
+            self.file = open(self.output_path, 'w', encoding='utf-8', buffering=SINK_BUFFER_SIZE)
+
+    def _write(self, record):
+        source, sha256, data, data_path, error = record
+        source = get_utf8_text(source)
+        error = get_utf8_text(error)
+        if self.use_sqlite:
+            if data_path:
+                with open(data_path, 'r') as f:
+                    data = f.read()
+            self.conn.execute('INSERT INTO results VALUES (?,?,?,?)', (source, sha256, data, error))
+            if (self.count + 1) % SINK_COMMIT_INTERVAL == 0:
+                self.conn.commit()
+        else:
+            line_start = ('{"source": ' + json.dumps(source) + ', "sha256": ' + json.dumps(sha256) +
+                          ', "error": ' + json.dumps(error) + ', "data": ')
+            if data_path:
+                with open(data_path, 'r') as f: # opened first, so a failure here leaves no partial line
+                    self.file.write(line_start)
+                    shutil.copyfileobj(f, self.file, SINK_BUFFER_SIZE)
+            else:
+                self.file.write(line_start + (data or 'null'))
+            self.file.write('}\n')
+
+    def _close(self):
+        if self.use_sqlite:
+            try:
+                self.conn.commit()
+            finally:
+                self.conn.close()
+        else:
+            self.file.close()
+
+def deserialize_job(job):
+    '''Process pool worker, job is (path, create_json, create_plist, cache_folder), 
+       returns (path, error, outputs, info)'''
+    path, create_json, create_plist, cache_folder = job
+    try:
+        error, outputs, info = deserialize_file(path, create_json, create_plist, cache_folder)
+    except Exception as ex: # anything else from the libraries should not stop the batch
+        error, outputs, info = f'Had exception: {type(ex).__name__} {str(ex)}', [], {}
+    return path, error, outputs, info
+
+def process_files(paths, create_json, create_plist, workers=None, sink=None, cache=None):
+    '''Deserializes files in parallel, writing outputs next to each file, or 
+       to the sink if one is provided. Results are reused from cache if given.'''
+    failed = 0
+    cache_folder = cache.cache_folder if cache else None
+    chunk_size = max(1, min(16, len(paths) // ((workers or os.cpu_count() or 1) * 4)))
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        if sink:
+            jobs = [(path, cache_folder, sink.temp_folder) for path in paths]
+            for path, sha256, data, data_path, error, info in executor.map(deserialize_to_record, jobs, chunksize=chunk_size):
+                sink.put(path, sha256, data, data_path, error)
+                if cache:
+                    cache.record(info)
+                if error:
+                    failed += 1
+                    print(f"Failed {get_utf8_text(path)} - {get_utf8_text(error)}")
+        else:
+            jobs = [(path, create_json, create_plist, cache_folder) for path in paths]
+            for path, error, outputs, info in executor.map(deserialize_job, jobs, chunksize=chunk_size):
+                if cache:
+                    cache.record(info)
+                if error:
+                    failed += 1
+                    print(f"Failed {get_utf8_text(path)} - {get_utf8_text(error)}")
+                else:
+                    for output_path in outputs:
+                        print(f"Wrote {get_utf8_text(output_path)}")
+    print(f"Done, deserialized {len(paths) - failed} files, {failed} failed")
+
+def process_folder_recursively(folder, create_json, create_plist, workers=None, sink=None, cache=None):
+    '''Deserializes all NSKeyedArchives under folder in parallel'''
+    paths, num_files = find_nska_files(folder)
+    print(f"Found {len(paths)} NSKeyedArchive files among {num_files} files")
+    if paths:
+        process_files(paths, create_json, create_plist, workers, sink, cache)
+
+def get_input_paths(input_path):
+    '''Returns input_path as a list, or all .plist files in it if it's a folder'''
     input_paths = []
     if os.path.isdir(input_path):
         print("Input path is a folder, will deserialise all .plist files found")
@@ -91,21 +589,45 @@ def main():
                 input_paths.append(os.path.join(input_path, name))
     else:
         input_paths.append(input_path)
+    return input_paths
+
+def process_files_with_sink(input_path, recursive, create_json, create_plist, workers, 
+                            sink_path, use_sqlite, cache):
+    '''Runs the parallel modes, with results going to sink_path if set'''
+    sink = None
+    if sink_path:
+        try:
+            sink = ResultSink(sink_path, use_sqlite)
+        except OSError as ex:
+            print(f"Error creating temporary folder - {str(ex)}")
+            return
+        sink.start()
+    try:
+        if recursive:
+            process_folder_recursively(input_path, create_json, create_plist, workers, sink, cache)
+        else:
+            process_files(get_input_paths(input_path), create_json, create_plist, workers, sink, cache)
+    finally:
+        if sink:
+            try:
+                sink.close()
+                print(f"Wrote {sink.count} results to {sink_path}" + 
+                      (f", {sink.failed} could not be written" if sink.failed else ''))
+            except (OSError, sqlite3.Error) as ex:
+                print(f"Error writing to {sink_path} - {str(ex)}")
 
+def process_files_serially(input_paths, create_json, create_plist, cache):
+    '''Original single process mode, writes outputs next to each input'''
+    cache_folder = cache.cache_folder if cache else None
     for path in input_paths:
         print(f"Reading file .. {path}")
         with open(path, 'rb') as f:
             try:
                 print("Trying to deserialize...")
-                deserialized_plist = nd.deserialize_plist(f, True) # Get Deserialized plist
-            except (nd.DeserializeError, 
-                    nd.biplist.NotBinaryPlistException, 
-                    nd.biplist.InvalidPlistException,
-                    nd.plistlib.InvalidFileException,
-                    nd.ccl_bplist.BplistError, 
-                    ValueError, 
-                    TypeError, OSError, OverflowError) as ex:
-                # These are all possible errors from libraries imported
+                deserialized_plist, info = load_deserialized_plist(f.read(), cache_folder) # Get Deserialized plist
+                if cache:
+                    cache.record(info)
+            except DESERIALIZE_ERRORS as ex:
                 print('Had exception: ' + str(ex))
                 print('Please send the offending plist my way to\n yogesh@swiftforensics.com')
                 deserialized_plist = None
@@ -116,11 +638,99 @@ def main():
 
                 if create_json:
                     print(f"Writing out .. {output_path_json}")
-                    nd.write_plist_to_json_file(deserialized_plist, output_path_json)
+                    write_plist_to_json_file(deserialized_plist, output_path_json)
                 if create_plist:
                     print(f"Writing out .. {output_path_plist}")
                     nd.write_plist_to_file(deserialized_plist, output_path_plist)
     return
 
+def main():
+    create_json = False
+    create_plist = True
+    recursive = False
+    workers = None
+    sink_path = None
+    use_sqlite = False
+    cache_folder = None
+    cache_size = DEFAULT_CACHE_SIZE_MB
+
+    if len(sys.argv) == 1:
+        print(usage)
+        return
+    
+    elif len(sys.argv) == 2:
+        input_path = sys.argv[1]
+
+    elif len(sys.argv) > 2:
+        args = sys.argv[1:]
+        while args and args[0].startswith('-') and not os.path.exists(args[0]):
+            option = args.pop(0).lower()
+            if option == '-h':
+                print(usage)
+                return
+            elif option == '-j':
+                create_json = True
+            elif option == '-r':
+                recursive = True
+            elif option == '-w' and args and args[0].isdigit() and int(args[0]) > 0:
+                workers = int(args.pop(0))
+            elif option in ('--jsonl', '--sqlite') and args and sink_path is None:
+                sink_path = args.pop(0)
+                use_sqlite = option == '--sqlite'
+            elif option == '--cache' and args:
+                cache_folder = os.path.abspath(args.pop(0))
+            elif option == '--cache-size' and args and args[0].isdigit():
+                cache_size = int(args.pop(0))
+            else:
+                print(f"Error, unrecognized input {option}")
+                return
+        if not args:
+            print(usage)
+            return
+        if len(args) > 1:
+            print(f"Error, unrecognized input {' '.join(args[1:])} (options go before the input path)")
+            return
+        input_path = args[0]
+
+    if not os.path.exists(input_path):
+        print(f"Error, input_file \"{input_path}\" does not exist! Check file path!")
+        print(usage)
+        return
+    
+    if recursive and not os.path.isdir(input_path):
+        print("Error, -r needs a folder as input")
+        return
+
+    if sink_path and not os.path.isdir(os.path.dirname(os.path.abspath(sink_path))):
+        print(f"Error, output folder for \"{sink_path}\" does not exist!")
+        return
+
+    cache = None
+    if cache_folder:
+        try:
+            load_cache_index()
+        except ImportError:
+            print("Error, --cache needs cache_index.py, copy it from the root folder of this repo "
+                  "next to this script (or one folder up)")
+            return
+        try:
+            cache = cache_index.CacheIndex(cache_folder, cache_size * 1024 * 1024)
+        except (OSError, sqlite3.Error) as ex:
+            print(f"Warning, could not open cache folder \"{cache_folder}\", continuing without cache - {str(ex)}")
+
+    try:
+        if recursive or sink_path:
+            process_files_with_sink(input_path, recursive, create_json, create_plist, workers,
+                                    sink_path, use_sqlite, cache)
+        else:
+            process_files_serially(get_input_paths(input_path), create_json, create_plist, cache)
+    finally:
+        if cache:
+            print(f"Cache had {cache.hits} hits, {cache.misses} misses")
+            try:
+                cache.close()
+            except sqlite3.Error as ex:
+                print(f"Error updating cache index - {str(ex)}")
+
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -31,6 +31,14 @@
 #                Read_ConfigProfiles.py  ConfigProfiles.reg
 #                Example: Read_ConfigProfiles.py  c:\ConfigProfiles.binary
 #
+#                For many machines at once, use batch mode (-b). Inputs can be 
+#                ConfigProfiles.binary files or image root folders, which are searched
+#                for the file. Files are parsed in parallel, and all domain users found 
+#                go to a single JSONL (-j) or SQLite (-s) output with the columns
+#                machine, source, uuid, user, first_login and error.
+#                Read_ConfigProfiles.py -b [-w workers] -j|-s <output file> <input> [<input> ..]
+#                Example: Read_ConfigProfiles.py -b -s c:\users.db e:\img1 e:\img2 f:\ConfigProfiles.binary
+#
 # Requirements:  Python (2 or 3) and ccl_bplist
 # 
 # Send bugs and feedback to yogesh@swiftforensics.com
@@ -40,10 +48,290 @@ from __future__ import print_function
 import ccl_bplist
 import sys
 import os
-import tempfile
+import mmap
 import struct
+import datetime
+import json
+import multiprocessing
+import sqlite3
+
+CONFIG_PROFILES_PATHS = (('private', 'var', 'db', 'ConfigurationProfiles', 'Store', 'ConfigProfiles.binary'),
+                         ('var', 'db', 'ConfigurationProfiles', 'Store', 'ConfigProfiles.binary'))
+
+class CoreDataStore:
+    '''Reads a CoreData binary store (like ConfigProfiles.binary), which is a header
+       followed by embedded binary plists. The file is memory mapped, and the header 
+       table of (offset, size) entries is validated when opened. Each plist is then
+       available as a memoryview into the mapping, nothing is copied. On Python 2, 
+       mmap has no buffer interface, so the file is read into memory instead.
+    '''
+    HEADER_SIZE = 0x30
+    TABLE_OFFSET = 0x10 # (offset, size) of each plist, 2 x 8 bytes big endian
+    TABLE_ENTRIES = 2
+
+    def __init__(self, path):
+        self.version = 0
+        self.plists = [] # memoryview for each table entry, None if entry is invalid
+        self._map = None
+        self._view = None
+        self._file = open(path, 'rb')
+        try:
+            file_size = os.fstat(self._file.fileno()).st_size
+            if file_size < self.HEADER_SIZE:
+                raise ValueError('File too small to be a CoreData store')
+            if sys.version_info.major > 2:
+                self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._map)
+            else:
+                self._view = memoryview(self._file.read())
+            if self._view[0:8].tobytes() != b'CoreData':
+                raise ValueError('File does not appear to be in the correct format')
+            self.version = struct.unpack_from('>I', self._view, 8)[0]
+            for index in range(self.TABLE_ENTRIES):
+                pos = self.TABLE_OFFSET + index * 16
+                offset, size = struct.unpack_from('>2Q', self._view, pos)
+                if offset >= self.HEADER_SIZE and size > 0 and (offset + size) <= file_size:
+                    self.plists.append(self._view[offset:offset + size])
+                else:
+                    self.plists.append(None)
+        except:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def get_plist(self, index):
+        '''Returns memoryview of the plist at index in the header table'''
+        if index >= len(self.plists) or self.plists[index] is None:
+            raise ValueError('Invalid data or file format changed')
+        return self.plists[index]
+
+    def close(self):
+        # All views must be released before the mapping can be closed
+        if sys.version_info.major > 2:
+            for view in self.plists + [self._view]:
+                if view is not None:
+                    view.release()
+        self.plists = []
+        self._view = None
+        if self._map:
+            self._map.close()
+            self._map = None
+        self._file.close()
+
+class MemoryViewReader:
+    '''Read-only file-like object over a memoryview, so that ccl_bplist.load() 
+       can read an embedded plist in place'''
+    def __init__(self, view):
+        self.view = view
+        self.pos = 0
+
+    def read(self, size=-1):
+        end = len(self.view) if size < 0 else min(self.pos + size, len(self.view))
+        data = self.view[self.pos:end].tobytes() if end > self.pos else b''
+        self.pos = max(self.pos, end)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        if whence == os.SEEK_CUR:
+            offset += self.pos
+        elif whence == os.SEEK_END:
+            offset += len(self.view)
+        self.pos = offset
+        return self.pos
+
+    def tell(self):
+        return self.pos
+
+class KeyedArchiveReader:
+    '''Reads objects of an NSKeyedArchiver binary plist on demand, instead of decoding
+       the whole object graph up front like ccl_bplist.load() does. Only the trailer, 
+       offset table and the list of archived objects are read when opened.
+
+       view : memoryview (or bytes) of the binary plist
+    '''
+    UINT_FORMATS = { 1:'B', 2:'H', 4:'I', 8:'Q' }
+
+    def __init__(self, view):
+        self.data = view
+        if len(view) < 40 or view[0:8].tobytes() != b'bplist00':
+            raise ValueError('Not a binary plist')
+        offset_size, self.ref_size, num_objects, top_index, table_offset = \
+            struct.unpack('>6xBBQQQ', view[-32:].tobytes())
+        if offset_size == 0 or self.ref_size == 0 or top_index >= num_objects or \
+           table_offset + num_objects * offset_size > len(view) - 32:
+            raise ValueError('Invalid binary plist trailer')
+        self.offsets = self._read_uints(table_offset, offset_size, num_objects)
+        if self.get_object(self._find_dict_value_ref(top_index, '$archiver')) != 'NSKeyedArchiver':
+            raise ValueError("Not an NSKeyedArchiver plist")
+        self.top = self.get_object(self._find_dict_value_ref(top_index, '$top'))
+        # UIDs in the archive are indexes into this list
+        self.objects = self._read_collection_refs(self._find_dict_value_ref(top_index, '$objects'))
+
+    def _read_uints(self, pos, size, count):
+        if size in self.UINT_FORMATS:
+            return list(struct.unpack_from('>' + self.UINT_FORMATS[size] * count, self.data, pos))
+        values = []
+        for i in range(count):
+            value = 0
+            for b in bytearray(self.data[pos + i * size : pos + (i + 1) * size].tobytes()):
+                value = (value << 8) | b
+            values.append(value)
+        return values
+
+    def _read_marker(self, index):
+        '''Returns (type, length, position of data) for object at index in offset table'''
+        pos = self.offsets[index]
+        marker = struct.unpack_from('>B', self.data, pos)[0]
+        obj_type, length = marker >> 4, marker & 0xF
+        pos += 1
+        if length == 0xF and obj_type in (0x4, 0x5, 0x6, 0xA, 0xC, 0xD): # length follows as int
+            int_size = 1 << (struct.unpack_from('>B', self.data, pos)[0] & 0xF)
+            length = self._read_uints(pos + 1, int_size, 1)[0]
+            pos += 1 + int_size
+        return obj_type, length, pos
+
+    def _read_collection_refs(self, index):
+        obj_type, length, pos = self._read_marker(index)
+        if obj_type not in (0xA, 0xC):
+            raise ValueError('Object {} is not an array'.format(index))
+        return self._read_uints(pos, self.ref_size, length)
+
+    def _read_dict_refs(self, index):
+        '''Returns (key refs, value refs) of dict at index, or None if not a dict'''
+        obj_type, length, pos = self._read_marker(index)
+        if obj_type != 0xD:
+            return None
+        refs = self._read_uints(pos, self.ref_size, length * 2)
+        return refs[:length], refs[length:]
+
+    def _find_dict_value_ref(self, index, key):
+        refs = self._read_dict_refs(index)
+        if refs is None:
+            raise ValueError('Object {} is not a dict'.format(index))
+        key_refs, value_refs = refs
+        for key_ref, value_ref in zip(key_refs, value_refs):
+            if self.get_object(key_ref) == key:
+                return value_ref
+        raise ValueError('Key {} not found'.format(key))
 
-def GetProfileInfo(f):
+    def is_string(self, index, length=None):
+        obj_type, obj_length, _ = self._read_marker(index)
+        return obj_type in (0x5, 0x6) and (length is None or obj_length == length)
+
+    def get_object(self, index):
+        '''Decodes object at index in offset table, arrays and dicts are decoded fully'''
+        obj_type, length, pos = self._read_marker(index)
+        if obj_type == 0x0:
+            return { 0x8:False, 0x9:True }.get(length, None)
+        elif obj_type == 0x1: # int
+            size = 1 << length
+            value = self._read_uints(pos, size, 1)[0]
+            if size >= 8 and value >= (1 << 63): 
+                value -= (1 << 64)
+            return value
+        elif obj_type == 0x2: # real
+            return struct.unpack_from('>f' if length == 2 else '>d', self.data, pos)[0]
+        elif obj_type == 0x3: # date
+            seconds = struct.unpack_from('>d', self.data, pos)[0]
+            return datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=seconds)
+        elif obj_type == 0x4: # data
+            return self.data[pos:pos + length].tobytes()
+        elif obj_type == 0x5: # ascii
+            return self.data[pos:pos + length].tobytes().decode('ascii')
+        elif obj_type == 0x6: # utf-16
+            return self.data[pos:pos + length * 2].tobytes().decode('utf_16_be')
+        elif obj_type == 0x8: # UID
+            return ccl_bplist.BplistUID(self._read_uints(pos, length + 1, 1)[0])
+        elif obj_type in (0xA, 0xC): # array, set
+            return [self.get_object(ref) for ref in self._read_uints(pos, self.ref_size, length)]
+        elif obj_type == 0xD: # dict
+            refs = self._read_uints(pos, self.ref_size, length * 2)
+            return dict((self.get_object(refs[i]), self.get_object(refs[length + i])) for i in range(length))
+        raise ValueError('Unknown object type {} at index {}'.format(obj_type, index))
+
+    def resolve(self, value):
+        '''Follows a UID to the archived object, converting common classes (NSString, 
+           NSDate, NSArray, NSSet, NSDictionary) to python types and $null to None'''
+        if isinstance(value, ccl_bplist.BplistUID):
+            value = self.get_object(self.objects[value.value])
+        if value == '$null':
+            return None
+        if isinstance(value, dict) and '$class' in value:
+            class_name = self.resolve(value['$class']).get('$classname')
+            if class_name in ('NSString', 'NSMutableString'):
+                return self.resolve(value['NS.string'])
+            elif class_name == 'NSDate':
+                return datetime.datetime(2001, 1, 1) + datetime.timedelta(seconds=value['NS.time'])
+            elif class_name in ('NSArray', 'NSMutableArray', 'NSSet', 'NSMutableSet'):
+                return [self.resolve(item) for item in value['NS.objects']]
+            elif class_name in ('NSDictionary', 'NSMutableDictionary'):
+                return dict((self.resolve(k), self.resolve(v)) for k, v in zip(value['NS.keys'], value['NS.objects']))
+        return value
+
+    def _get_dict_keys(self, index, key_names):
+        '''Returns {key string: value ref} of dict at index, or None if not a dict.
+           key_names caches key strings by offset table index across calls.'''
+        refs = self._read_dict_refs(index)
+        if refs is None:
+            return None
+        keys = {}
+        for key_ref, value_ref in zip(*refs):
+            if key_ref not in key_names:
+                key_names[key_ref] = self.get_object(key_ref) if self.is_string(key_ref) else None
+            keys[key_names[key_ref]] = value_ref
+        return keys
+
+    def get_entity_attributes(self, entity_name, attribute_indexes):
+        '''Returns a list with the requested NSAttributeValues items for each archived
+           CoreData entity named entity_name. Only strings of the right length are 
+           looked at to find the entity name (also when wrapped in an NSString 
+           object), and only matching entities are decoded. Returns None if the 
+           entity name is not found as a string at all.'''
+        entity_uids = set()
+        for uid, index in enumerate(self.objects):
+            if self.is_string(index, len(entity_name)) and self.get_object(index) == entity_name:
+                entity_uids.add(uid)
+        if not entity_uids:
+            return None
+        key_names = {} # key strings by offset table index, each is decoded just once
+        for uid, index in enumerate(self.objects): # NSString objects holding the name
+            keys = self._get_dict_keys(index, key_names)
+            if keys and 'NS.string' in keys:
+                value = self.get_object(keys['NS.string'])
+                if isinstance(value, ccl_bplist.BplistUID) and value.value in entity_uids:
+                    entity_uids.add(uid)
+        results = []
+        for index in self.objects:
+            keys = self._get_dict_keys(index, key_names)
+            if keys is None or 'NSEntityName' not in keys or 'NSAttributeValues' not in keys:
+                continue
+            entity = self.get_object(keys['NSEntityName'])
+            if isinstance(entity, ccl_bplist.BplistUID) and entity.value in entity_uids:
+                attributes = self.get_object(keys['NSAttributeValues'])
+                attributes = self.get_object(self.objects[attributes.value]) # NSArray
+                items = attributes['NS.objects']
+                results.append([self.resolve(items[i]) for i in attribute_indexes])
+        return results
+
+def GetProfileInfo(view):
+    '''Returns [UUID, user name, date first logged in] for each MCX_Profile, reading
+       only those records from the plist. If the plist isn't laid out as expected, 
+       or the entity name isn't found in it, falls back to deserializing all of it.'''
+    try:
+        profiles = KeyedArchiveReader(view).get_entity_attributes('MCX_Profile', (0, 1, 2))
+        if profiles is not None:
+            return profiles
+        print('Entity name not found while reading selectively, trying full deserialization..')
+    except (ValueError, TypeError, KeyError, IndexError, AttributeError, struct.error) as ex:
+        print('Reading selectively failed ({}), trying full deserialization..'.format(str(ex)))
+    return GetProfileInfoFromWholeStructure(MemoryViewReader(view))
+
+def GetProfileInfoFromWholeStructure(f):
     profiles = []
     ccl_bplist.set_object_converter(ccl_bplist.NSKeyedArchiver_common_objects_convertor)
     plist = ccl_bplist.load(f)
@@ -63,30 +351,133 @@ def GetProfileInfo(f):
             profiles.append(attributes)
     return profiles
 
-usage = "Usage:\nRead_ConfigProfiles.py  ConfigProfiles.binary\n" 
+def FindConfigProfilesFiles(root):
+    '''Returns paths of ConfigProfiles.binary files in an image root folder. Looks at the
+       usual location first, else searches the whole folder (which may hold many images).'''
+    for parts in CONFIG_PROFILES_PATHS:
+        path = os.path.join(root, *parts)
+        if os.path.isfile(path):
+            return [path]
+    found = []
+    for folder, _, files in os.walk(root):
+        for name in files:
+            if name.lower() == 'configprofiles.binary':
+                found.append(os.path.join(folder, name))
+    return found
+
+def GetMachineName(root, path):
+    '''Returns name of the image folder the file at path belongs to, that is the folder
+       above private/var/db/.. if the file is at its usual location, else the root name.'''
+    for parts in CONFIG_PROFILES_PATHS:
+        suffix = os.sep + os.path.join(*parts)
+        if path.lower().endswith(suffix.lower()):
+            name = os.path.basename(os.path.normpath(os.path.abspath(path[:-len(suffix)] or os.sep)))
+            if name:
+                return name
+    return os.path.basename(os.path.normpath(os.path.abspath(root)))
+
+def ReadDomainUsers(job):
+    '''Runs in a worker process. Returns (machine, source, [(uuid, user, first_login),..], error)
+       for one ConfigProfiles.binary file, errors are returned and not raised.'''
+    machine, path = job
+    try:
+        with CoreDataStore(path) as store:
+            profiles = GetProfileInfo(store.get_plist(1))
+        users = []
+        for p in profiles:
+            if p[0] and len(p[0]) == 36: # Filter out non-domain items
+                users.append((p[0], p[1], str(p[2])))
+        return machine, path, users, ''
+    except Exception as ex:
+        return machine, path, [], str(ex)
+
+def ProcessInBatch(inputs, output_path, output_format, workers=None):
+    '''Reads domain users from all inputs (files or image roots) into one JSONL or SQLite
+       output. output_format is 'jsonl' or 'sqlite'.'''
+    jobs = []
+    for input_path in inputs:
+        if os.path.isdir(input_path):
+            paths = FindConfigProfilesFiles(input_path)
+            if not paths:
+                print('No ConfigProfiles.binary found in ' + input_path)
+            jobs.extend([(GetMachineName(input_path, path), path) for path in paths])
+        else:
+            jobs.append(('', input_path))
+    print('Processing {} files'.format(len(jobs)))
+
+    if output_format == 'sqlite':
+        db = sqlite3.connect(output_path)
+        db.execute("CREATE TABLE IF NOT EXISTS domain_users (machine TEXT, source TEXT, uuid TEXT, user TEXT, first_login TEXT, error TEXT)")
+        db.execute("CREATE INDEX IF NOT EXISTS domain_users_source ON domain_users (source)")
+        out_file = None
+    else:
+        out_file = open(output_path, 'w')
+        db = None
+    num_users = 0
+    num_errors = 0
+    pool = multiprocessing.Pool(workers if workers else multiprocessing.cpu_count())
+    try:
+        for machine, source, users, error in pool.imap_unordered(ReadDomainUsers, jobs):
+            if error:
+                print('Error reading {} : {}'.format(source, error))
+                num_errors += 1
+                rows = [(machine, source, None, None, None, error)]
+            else:
+                rows = [(machine, source) + user + (None,) for user in users]
+                num_users += len(users)
+            if db: # Rows from an earlier run on the same source are replaced
+                db.execute("DELETE FROM domain_users WHERE source=?", (source,))
+                db.executemany("INSERT INTO domain_users VALUES (?,?,?,?,?,?)", rows)
+            else:
+                for row in rows:
+                    out_file.write(json.dumps(dict(zip(('machine', 'source', 'uuid', 'user', 'first_login', 'error'), row))) + '\n')
+    finally:
+        pool.close()
+        pool.join()
+        if db:
+            db.commit()
+            db.close()
+        else:
+            out_file.close()
+    print('Done, found {} domain users. {} files had errors. Output is at {}'.format(num_users, num_errors, output_path))
+
+usage = ("Usage:\nRead_ConfigProfiles.py  ConfigProfiles.binary\n"
+         "Batch mode:\nRead_ConfigProfiles.py -b [-w workers] -j|-s <output file> <input> [<input> ..]\n"
+         " Inputs are ConfigProfiles.binary files or image root folders. Output is JSONL (-j)\n"
+         " or SQLite (-s), with machine, source, uuid, user, first_login, error columns. An\n"
+         " existing SQLite output is updated, rows of sources read again are replaced.\n")
 
-if len(sys.argv) > 1:
-    inputPath = sys.argv[1]
+def batch_main(args):
+    workers = None
+    output_format = None
+    output_path = None
     try:
-        with open(inputPath, 'rb') as configfile:
-            configfile_size = os.path.getsize(inputPath)
-            header = configfile.read(8)
-            if header == b'CoreData':
-                version = configfile.read(4)
-                if (version != b'\x00\x00\x00\x01'): 
+        while args and args[0] in ('-w', '-j', '-s'):
+            if args[0] == '-w':
+                workers = int(args[1])
+            else:
+                output_format = 'jsonl' if args[0] == '-j' else 'sqlite'
+                output_path = args[1]
+            args = args[2:]
+    except (IndexError, ValueError):
+        print('Error, -w needs a number and -j/-s need an output file path')
+        return
+    if not output_path or not args:
+        print('Not enough parameters')
+        print(usage)
+        return
+    ProcessInBatch(args, output_path, output_format, workers)
+
+def main():
+    if len(sys.argv) > 1 and sys.argv[1] == '-b':
+        batch_main(sys.argv[2:])
+    elif len(sys.argv) > 1:
+        inputPath = sys.argv[1]
+        try:
+            with CoreDataStore(inputPath) as store:
+                if store.version != 1: 
                     print('File version is different, this may not work! Trying.. ')
-                configfile.seek(0x20) # jumping to 2nd plist's meta info
-                plist_metadata = configfile.read(16)
-                offset, size   = struct.unpack(">2Q", plist_metadata[0:16])
-                configfile.seek(offset)
-                data = configfile.read(size)
-                if (offset > configfile_size) or ((offset + size) > configfile_size):
-                    exit('Invalid data or file format changed, Exiting..')
-                f = tempfile.SpooledTemporaryFile(max_size=size)
-                f.write(data)
-                f.seek(0)
-
-                user_profiles = GetProfileInfo(f)
+                user_profiles = GetProfileInfo(store.get_plist(1)) # 2nd plist
                 i = 1
                 if (len(user_profiles)) > 0:
                     user_profiles = sorted(user_profiles, key=lambda x: x[2], reverse=True)
@@ -97,10 +488,13 @@ if len(sys.argv) > 1:
                             i += 1
                 else:
                     print ('No user profile information found!')
-            else:
-                print('File does not appear to be in the correct format')
-    except Exception as ex:
-        print ('Error opening file: ' + str(ex))
-else:
-    print('Not enough parameters')
-    print(usage)
+        except ValueError as ex:
+            print(str(ex))
+        except Exception as ex:
+            print ('Error opening file: ' + str(ex))
+    else:
+        print('Not enough parameters')
+        print(usage)
+
+if __name__ == "__main__":
+    main()
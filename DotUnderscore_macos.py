@@ -0,0 +1,516 @@
+#
+# Parser for AppleDouble ._ files created by macOS
+# Copyright (c) 2018-2024  Yogesh Khatri <yogesh@swiftforensics.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can get a copy of the complete license here:
+#  <http://www.gnu.org/licenses/>.
+#
+# Script Name  : DotUnderscore_macos.py
+# Author       : Yogesh Khatri
+# Purpose      : When macOS copies files to volumes that can't store extended
+#                attributes (FAT, exFAT, SMB shares..), it writes them to a
+#                companion file with ._ prepended to the name (._ABC.jpg).
+#                This reads those files, same structures as the 010 template
+#                DotUnderscore_macos.bt - Header, Entry table, the ATTR header
+#                and AttrDefinition records in entry 9 and the resource fork
+#                in entry 2.
+#                The file is memory mapped and values are returned as
+#                memoryview slices of it, so nothing is copied or read from
+#                disk until used, and large resource forks are never loaded
+#                unless asked for.
+#                The harvest mode finds all ._ files under a folder (directories
+#                are scanned in parallel threads), parses them in batches in a
+#                pool of processes, and writes every attribute as a row of
+#                (file, xattr name, decoded value) to a tab separated file.
+#                Binary plist values (like kMDItemWhereFroms) are decoded with
+#                ccl_bplist, found in the Domain_Info folder if not installed.
+#                The index mode stores the same in an sqlite database that can
+#                be queried later. Running it again on the same folder only
+#                parses ._ files that are new or whose size or modified time 
+#                changed, and drops files that no longer exist.
+# Usage        : DotUnderscore_macos.py <._file>
+#                DotUnderscore_macos.py harvest <FOLDER> <OUTPUT.tsv> [WORKERS]
+#                DotUnderscore_macos.py index <FOLDER> <INDEX.db> [WORKERS]
+#                DotUnderscore_macos.py query <INDEX.db> <XATTR_NAME> [TEXT]
+#                  Lists files having the attribute, with TEXT in its value if
+#                  given, eg. query idx.db com.apple.metadata:kMDItemWhereFroms example.com
+#                As a module:
+#                  with AppleDouble_reader(path) as ad:
+#                      for name, value in ad.iter_xattrs():
+#                          ...
+# Requirements : Python3
+#
+
+import io
+import mmap
+import os
+import sqlite3
+import struct
+import sys
+import time
+
+APPLEDOUBLE_MAGIC = 0x00051607
+ENTRY_RESOURCE_FORK = 2
+ENTRY_FINDER_INFO = 9    # Finder info, followed by extended attributes
+ATTR_SIGNATURE = b'ATTR'
+ATTR_HEADER_OFFSET = 0x22 # from start of entry 9, after 32 bytes of Finder info + 2 padding
+
+HEADER = struct.Struct('>IHH16sH')       # Magic, Version, Reserved, Macosx, NumEntries
+ENTRY = struct.Struct('>III')            # Id, Offset, Size
+ATTR_HEADER = struct.Struct('>4sIIIIIIIHH') # Signature .. Unknown5, Flags, NumAttributes
+ATTR_DEFINITION = struct.Struct('>IIHB') # ValueOffset, ValueLen, Unknown, NameLen
+RESOURCE_FORK_NAME = 'com.apple.ResourceFork'
+
+DEFAULT_WALK_THREADS = 16  # directory listing is mostly waiting on disk/network
+HARVEST_BATCH_SIZE = 256   # ._ files parsed per worker job
+MAX_VALUE_TEXT = 4096      # longer decoded values are cut short in output
+INDEX_COMMIT_INTERVAL = 100000 # rows
+
+ccl_bplist = None # imported by load_ccl_bplist()
+
+class AppleDoubleError(Exception):
+    pass
+
+class AppleDouble_reader:
+    '''Reads an AppleDouble (._) file. Raises AppleDoubleError if it isn't one,
+       OSError if it can't be read. Use close() (or a with block) when done,
+       after releasing any values obtained from it.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.entries = [] # list of (id, offset, size)
+        self._mmap = None
+        with open(path, 'rb') as f:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+            except (ValueError, OSError): # empty file or mmap not supported
+                self._view = memoryview(f.read())
+        try:
+            self._read_header()
+        except AppleDoubleError:
+            self.close()
+            raise
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        self._view.release()
+        if self._mmap:
+            try:
+                self._mmap.close()
+            except BufferError: # caller still holds a value, mmap closes when released
+                pass
+            self._mmap = None
+
+    def _read_header(self):
+        view = self._view
+        if len(view) < HEADER.size:
+            raise AppleDoubleError('File too small')
+        magic, self.version, _, _, num_entries = HEADER.unpack_from(view, 0)
+        if magic != APPLEDOUBLE_MAGIC:
+            raise AppleDoubleError(f'Not the right signature 0x{magic:08X}')
+        pos = HEADER.size
+        for _ in range(num_entries):
+            if pos + ENTRY.size > len(view):
+                break # truncated, keep the entries read so far
+            self.entries.append(ENTRY.unpack_from(view, pos))
+            pos += ENTRY.size
+
+    def _get_slice(self, offset, size):
+        '''Returns view of file data, clamped to file size for truncated files'''
+        end = min(offset + size, len(self._view))
+        return self._view[min(offset, end):end]
+
+    def get_entry(self, entry_id):
+        '''Returns (offset, size) of first entry with entry_id or None'''
+        for id_, offset, size in self.entries:
+            if id_ == entry_id:
+                return offset, size
+        return None
+
+    def get_resource_fork(self):
+        '''Returns memoryview of the resource fork, or None if there is none'''
+        entry = self.get_entry(ENTRY_RESOURCE_FORK)
+        if entry and entry[1]:
+            return self._get_slice(*entry)
+        return None
+
+    def get_attr_header(self):
+        '''Returns ATTR header values as tuple (Signature, Unknown1, LogicalFileSize,
+           ValuesOffset, ValuesLen, Unknown3, Unknown4, Unknown5, Flags, NumAttributes)
+           and position of first AttrDefinition, or (None, 0) if there are no attributes.
+        '''
+        entry = self.get_entry(ENTRY_FINDER_INFO)
+        if not entry:
+            return None, 0
+        pos = entry[0] + ATTR_HEADER_OFFSET
+        if pos + ATTR_HEADER.size > len(self._view):
+            return None, 0
+        attr_header = ATTR_HEADER.unpack_from(self._view, pos)
+        if attr_header[0] != ATTR_SIGNATURE: # Finder info only
+            return None, 0
+        return attr_header, pos + ATTR_HEADER.size
+
+    def iter_xattrs(self):
+        '''Yields (name, value) for each extended attribute, value is a memoryview
+           of the file. Attributes are parsed one at a time as iterated.
+        '''
+        attr_header, pos = self.get_attr_header()
+        if not attr_header:
+            return
+        view = self._view
+        for _ in range(attr_header[9]):
+            if pos + ATTR_DEFINITION.size > len(view):
+                break
+            value_offset, value_len, _, name_len = ATTR_DEFINITION.unpack_from(view, pos)
+            pos += ATTR_DEFINITION.size
+            name = bytes(view[pos:pos + name_len]).rstrip(b'\0').decode('utf-8', 'backslashreplace')
+            pos += name_len
+            if pos % 4:
+                pos += 4 - (pos % 4)
+            yield name, self._get_slice(value_offset, value_len)
+
+    def get_xattr(self, name):
+        '''Returns value (memoryview) of attribute called name, or None'''
+        for attr_name, value in self.iter_xattrs():
+            if attr_name == name:
+                return value
+        return None
+
+def load_ccl_bplist():
+    '''Imports ccl_bplist, from the Domain_Info folder of this repo if not installed'''
+    global ccl_bplist
+    if ccl_bplist is None:
+        try:
+            import ccl_bplist as module
+        except ImportError:
+            sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Domain_Info'))
+            import ccl_bplist as module
+        ccl_bplist = module
+
+def FormatPlistObject(obj):
+    '''Returns text for a value read by ccl_bplist'''
+    if isinstance(obj, str):
+        return obj
+    elif isinstance(obj, bytes):
+        return obj.hex()
+    elif isinstance(obj, (list, tuple)):
+        return ', '.join(FormatPlistObject(item) for item in obj)
+    elif isinstance(obj, dict):
+        return '{' + ', '.join(f'{FormatPlistObject(k)}: {FormatPlistObject(v)}' for k, v in obj.items()) + '}'
+    return str(obj)
+
+def DecodeValue(value):
+    '''Returns printable text for an attribute value. Binary plists are decoded, 
+       text is returned as is, anything else as hex.'''
+    if value[0:8] == b'bplist00':
+        load_ccl_bplist()
+        try:
+            return FormatPlistObject(ccl_bplist.load(io.BytesIO(value)))
+        except (ccl_bplist.BplistError, struct.error, IndexError, ValueError, 
+                TypeError, KeyError, OverflowError, RecursionError):
+            pass # damaged, show as hex
+    else:
+        try:
+            text = bytes(value).rstrip(b'\0').decode('utf-8')
+            if text.isprintable():
+                return text
+        except UnicodeDecodeError:
+            pass
+    return bytes(value).hex()
+
+def RemoveTabsNewLines(text):
+    return text.replace('\t', ' ').replace('\r', ' ').replace('\n', ' ')
+
+def GetUtf8Text(text):
+    '''Escapes what can't go in the UTF-8 TSV or index db, which is bytes of 
+       undecodable file names and lone surrogates in attribute values'''
+    try:
+        text.encode('utf-8')
+        return text
+    except UnicodeEncodeError:
+        try:
+            return os.fsencode(text).decode('utf-8', 'backslashreplace')
+        except UnicodeError:
+            return text.encode('utf-8', 'backslashreplace').decode('utf-8')
+
+def GetTsvText(text):
+    return RemoveTabsNewLines(GetUtf8Text(text))
+
+def ReadXattrs(path):
+    '''Returns list of (name, decoded value) for all attributes of the ._ file,
+       including the resource fork (as its size). Raises AppleDoubleError, OSError'''
+    xattrs = []
+    with AppleDouble_reader(path) as ad:
+        for name, value in ad.iter_xattrs():
+            xattrs.append((name, DecodeValue(value)))
+            value.release()
+        fork = ad.get_resource_fork()
+        if fork:
+            xattrs.append((RESOURCE_FORK_NAME, f'{len(fork)} bytes'))
+            fork.release()
+    return xattrs
+
+def HarvestBatch(paths):
+    '''Process pool worker, parses a batch of ._ files. Returns (rows, errors) 
+       where rows is list of (path, name, value) and errors is list of (path, error)'''
+    rows = []
+    errors = []
+    for path in paths:
+        try:
+            for name, value in ReadXattrs(path):
+                rows.append((path, name, value))
+        except (AppleDoubleError, OSError) as ex:
+            errors.append((path, str(ex)))
+    return rows, errors
+
+def ScanFolder(path):
+    '''Lists one directory, returns (list of (path, size, mtime_ns) of ._ files, list of 
+       subfolders, list of paths that could not be read). The last has path itself if it
+       could not be listed, or entries in it whose type or size could not be read.'''
+    files = []
+    folders = []
+    failed = []
+    try:
+        with os.scandir(path) as it:
+            for entry in it:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        folders.append(entry.path)
+                    elif entry.name.startswith('._') and entry.is_file(follow_symlinks=False):
+                        stat = entry.stat(follow_symlinks=False)
+                        files.append((entry.path, stat.st_size, stat.st_mtime_ns))
+                except OSError:
+                    failed.append(entry.path)
+    except OSError: # no permission, folder removed or share unavailable
+        failed.append(path)
+    return files, folders, failed
+
+def FindDotUnderscoreFiles(root, threads=DEFAULT_WALK_THREADS, failed_paths=None):
+    '''Walks the folder tree with os.scandir, listing many directories at a time 
+       in a pool of threads. Yields (path, size, mtime_ns) for each ._ file. Folders
+       (or entries) that could not be read are added to the failed_paths list if given.'''
+    from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        pending = {executor.submit(ScanFolder, root)}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                files, folders, failed = future.result()
+                if failed_paths is not None:
+                    failed_paths.extend(failed)
+                for folder in folders:
+                    pending.add(executor.submit(ScanFolder, folder))
+                yield from files
+
+def IterBatches(items, batch_size):
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+def ParseInParallel(files, workers=None):
+    '''Parses ._ files from an iterable of (path, size, mtime_ns) in batches in a 
+       pool of processes. Yields (batch, rows, errors) as each batch completes,
+       where batch is the list of (path, size, mtime_ns) and the rest is as
+       returned by HarvestBatch().'''
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = {}
+        for batch in IterBatches(files, HARVEST_BATCH_SIZE):
+            pending[executor.submit(HarvestBatch, [path for path, _, _ in batch])] = batch
+            if len(pending) >= workers * 4: # keep memory bounded on huge trees
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield (pending.pop(future),) + future.result()
+        for future in list(pending):
+            yield (pending.pop(future),) + future.result()
+
+def HarvestFolder(root, output_path, workers=None):
+    '''Parses all ._ files under root, writes (File, Name, Value) rows to 
+       output_path as tab separated text. Returns (files, rows, errors) counts'''
+    num_files = num_rows = num_errors = 0
+    with open(output_path, 'w', encoding='utf-8', newline='') as out_file:
+        out_file.write('File\tName\tValue\n')
+        for batch, rows, errors in ParseInParallel(FindDotUnderscoreFiles(root), workers):
+            num_files += len(batch)
+            num_rows += len(rows)
+            num_errors += len(errors)
+            out_file.writelines(f'{GetTsvText(path)}\t{GetTsvText(name)}\t'
+                                f'{GetTsvText(value[:MAX_VALUE_TEXT])}\n' for path, name, value in rows)
+    return num_files, num_rows, num_errors
+
+class XattrIndex:
+    '''SQLite index of harvested attributes. Table files has every ._ file seen 
+       with its size and modified time (and error if it could not be parsed),
+       table xattrs has the decoded (path, name, value) rows.'''
+    def __init__(self, db_path):
+        self.conn = sqlite3.connect(db_path)
+        self.pending_rows = 0
+        self.conn.executescript('''
+            CREATE TABLE IF NOT EXISTS files (path TEXT PRIMARY KEY, size INTEGER, mtime_ns INTEGER, error TEXT);
+            CREATE TABLE IF NOT EXISTS xattrs (path TEXT, name TEXT, value TEXT);
+            CREATE INDEX IF NOT EXISTS xattrs_path ON xattrs (path);
+            CREATE INDEX IF NOT EXISTS xattrs_name_value ON xattrs (name, value);
+        ''')
+
+    def get_known_files(self):
+        '''Returns dict of path: (size, mtime_ns) for all files in index'''
+        return {path: (size, mtime_ns) for path, size, mtime_ns in 
+                self.conn.execute('SELECT path, size, mtime_ns FROM files')}
+
+    def update(self, batch, rows, errors):
+        '''Replaces entries for files in batch with new results from HarvestBatch()'''
+        # Paths are stored as GetUtf8Text(path), sqlite can't take ones that aren't valid UTF-8
+        error_dict = dict(errors)
+        paths = [(GetUtf8Text(path),) for path, _, _ in batch]
+        self.conn.executemany('DELETE FROM xattrs WHERE path=?', paths)
+        self.conn.executemany('INSERT OR REPLACE INTO files (path, size, mtime_ns, error) VALUES (?,?,?,?)', 
+                              [(GetUtf8Text(path), size, mtime_ns, 
+                                GetUtf8Text(error_dict[path]) if path in error_dict else None) 
+                               for path, size, mtime_ns in batch])
+        self.conn.executemany('INSERT INTO xattrs (path, name, value) VALUES (?,?,?)', 
+                              [(GetUtf8Text(path), GetUtf8Text(name), GetUtf8Text(value)) for path, name, value in rows])
+        self._commit_every(len(batch) + len(rows))
+
+    def remove(self, paths):
+        '''Removes files (no longer existing) from index, paths are as stored'''
+        paths = [(path,) for path in paths]
+        self.conn.executemany('DELETE FROM xattrs WHERE path=?', paths)
+        self.conn.executemany('DELETE FROM files WHERE path=?', paths)
+        self._commit_every(len(paths))
+
+    def _commit_every(self, num_rows):
+        self.pending_rows += num_rows
+        if self.pending_rows >= INDEX_COMMIT_INTERVAL:
+            self.conn.commit()
+            self.pending_rows = 0
+
+    def query(self, name, text=None):
+        '''Returns list of (path, value) for attribute name, only where value 
+           contains text if given'''
+        if text:
+            escaped = text.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            return self.conn.execute("SELECT path, value FROM xattrs WHERE name=? AND value LIKE ? ESCAPE '\\' ORDER BY path", 
+                                     (name, '%' + escaped + '%')).fetchall()
+        return self.conn.execute('SELECT path, value FROM xattrs WHERE name=? ORDER BY path', (name,)).fetchall()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+def IndexFolder(root, db_path, workers=None):
+    '''Adds all ._ files under root to the index at db_path, parsing only files that
+       are new or changed (size or mtime) since the last run, and removing files 
+       no longer present. Files under folders that could not be listed this time 
+       are kept. Returns (files, parsed, removed, errors, unreadable folders) counts'''
+    root = os.path.abspath(root)
+    index = XattrIndex(db_path)
+    num_files = num_parsed = num_errors = 0
+    failed_paths = []
+    try:
+        known_files = index.get_known_files()
+
+        def changed_files():
+            nonlocal num_files
+            for path, size, mtime_ns in FindDotUnderscoreFiles(root, failed_paths=failed_paths):
+                num_files += 1
+                if known_files.pop(GetUtf8Text(path), None) != (size, mtime_ns):
+                    yield path, size, mtime_ns
+
+        for batch, rows, errors in ParseInParallel(changed_files(), workers):
+            num_parsed += len(batch)
+            num_errors += len(errors)
+            index.update(batch, rows, errors)
+        # whatever is left under root was not found this time, unless it was
+        # somewhere that could not be read (a share dropping out shouldn't empty the index)
+        prefix = GetUtf8Text(os.path.join(root, ''))
+        failed = set(GetUtf8Text(path) for path in failed_paths)
+        failed_prefixes = tuple(os.path.join(path, '') for path in failed)
+        removed = [path for path in known_files if path.startswith(prefix) and 
+                   path not in failed and not path.startswith(failed_prefixes)]
+        index.remove(removed)
+    finally:
+        index.close()
+    return num_files, num_parsed, len(removed), num_errors, len(failed)
+
+def PrintXattrs(path):
+    try:
+        with AppleDouble_reader(path) as ad:
+            print(f'Version {ad.version}, {len(ad.entries)} entries')
+            for entry_id, offset, size in ad.entries:
+                print(f'  Entry Id={entry_id} Offset=0x{offset:X} Size={size}')
+        for name, value in ReadXattrs(path):
+            print(GetUtf8Text(f'{name} = {value}'))
+    except (AppleDoubleError, OSError) as ex:
+        print(GetUtf8Text(f'Error reading {path} - {str(ex)}'))
+
+def main():
+    usage = 'Usage: DotUnderscore_macos.py <._file>\n' \
+            '       DotUnderscore_macos.py harvest <FOLDER> <OUTPUT.tsv> [WORKERS]\n' \
+            '       DotUnderscore_macos.py index <FOLDER> <INDEX.db> [WORKERS]\n' \
+            '       DotUnderscore_macos.py query <INDEX.db> <XATTR_NAME> [TEXT]'
+    if len(sys.argv) == 2:
+        PrintXattrs(sys.argv[1])
+    elif len(sys.argv) in (4, 5) and sys.argv[1] == 'query':
+        if not os.path.isfile(sys.argv[2]):
+            print(f'Error, index "{sys.argv[2]}" does not exist')
+            return
+        try:
+            index = XattrIndex(sys.argv[2])
+            for path, value in index.query(sys.argv[3], sys.argv[4] if len(sys.argv) == 5 else None):
+                print(f'{path}\t{RemoveTabsNewLines(value)}')
+            index.close()
+        except sqlite3.Error as ex:
+            print(f'Error reading index {sys.argv[2]} - {str(ex)}')
+    elif len(sys.argv) in (4, 5) and sys.argv[1] in ('harvest', 'index'):
+        folder, output_path = sys.argv[2], sys.argv[3]
+        workers = None
+        if len(sys.argv) == 5:
+            if not sys.argv[4].isdigit() or int(sys.argv[4]) == 0:
+                print(usage)
+                return
+            workers = int(sys.argv[4])
+        if not os.path.isdir(folder):
+            print(f'Error, folder "{folder}" does not exist')
+            return
+        start = time.time()
+        try:
+            if sys.argv[1] == 'index':
+                num_files, num_parsed, num_removed, num_errors, num_failed = IndexFolder(folder, output_path, workers)
+                print(f'Found {num_files} ._ files, parsed {num_parsed} new or changed ({num_errors} not parsed), '
+                      f'removed {num_removed} from index in {time.time() - start:.1f} s')
+                if num_failed:
+                    print(f'{num_failed} folders or files could not be read, their entries in the index were kept')
+                return
+            num_files, num_rows, num_errors = HarvestFolder(folder, output_path, workers)
+        except (OSError, sqlite3.Error) as ex:
+            print(f'Error writing to {output_path} - {str(ex)}')
+            return
+        print(f'Read {num_files} ._ files ({num_errors} not parsed), wrote {num_rows} attributes '
+              f'to {output_path} in {time.time() - start:.1f} s')
+    else:
+        print(usage)
+
+if __name__ == '__main__':
+    main()
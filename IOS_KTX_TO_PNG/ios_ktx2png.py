@@ -28,19 +28,258 @@
 
     Output will be in the same folder, called SAMPLE.KTX.png
 
+    python3 ios_ktx2png.py [-o OUTPUT_FOLDER] [--flat] [-w WORKERS] FOLDER
+
+    All KTX/AAPL files found recursively under FOLDER are converted using
+    a pool of worker processes (one per cpu by default). Files are 
+    recognized by their header, not their extension. Output goes next to
+    each file, or into OUTPUT_FOLDER mirroring the source tree. With 
+    --flat, all files are written directly in OUTPUT_FOLDER, named after
+    their relative path. Files that fail are reported and skipped.
+
+    python3 ios_ktx2png.py --preview [--preview-size MAX_SIZE] FILE_OR_FOLDER
+
+    Writes small thumbnails (SAMPLE.KTX.preview.png, default 256 pixels
+    on the longer side) for review galleries. The smallest mipmap level 
+    that is big enough is used if the file has mipmaps, otherwise only 
+    every n-th ASTC block is decoded before scaling down. 
+
+    python3 ios_ktx2png.py --tiled [--band-rows N] FILE_OR_FOLDER
+
+    For very large textures. Decodes N rows of 4x4 blocks at a time 
+    (default 64) and streams them into the PNG, so the decoded image is 
+    never held in memory whole.
+
+    Output options (all modes)
+    --format png|rgba|bmp|jpeg|webp  Output format, rgba is raw pixel data
+    --level 0-9          PNG zlib compression level (default 6, 1 for previews)
+    --strategy NAME      PNG zlib strategy: default, filtered, huffman, rle, fixed
+    --quality 1-100      JPEG/WebP quality
+    --fast               Preset for throughput (PNG level 1 with rle strategy,
+                         fastest WebP method)
+    --timing             Print time spent per stage (read, lzfse, astc, encode, 
+                         write) summed over all files
+
+    python3 ios_ktx2png.py --cache CACHE_FOLDER [--cache-size MB] FILE_OR_FOLDER
+
+    Converted images are kept in CACHE_FOLDER, keyed by SHA-256 of the 
+    KTX file content (and conversion options). Files seen before, in this 
+    or an earlier run or extraction, are copied from the cache instead of 
+    being decoded again. Least recently used entries are removed once the
+    cache grows over the size limit (default 1024 MB). This needs 
+    cache_index.py, from the root folder of this repo, next to this 
+    script or one folder up. Nothing else needs it.
+
+    python3 ios_ktx2png.py --index INVENTORY.csv FOLDER
+
+    Only headers are read, nothing is converted. Writes an inventory of 
+    all KTX/AAPL files with dimensions, format, compression, timestamps 
+    and whether this code can convert them. Use a .json extension for 
+    JSON output, else CSV is written. None of the dependencies above are
+    needed for this.
+
     See main 
 """
 
-import astc_decomp 
-import liblzfse
+import argparse
+import csv
+import datetime
+import hashlib
+import importlib.util
+import io
+import json
+import mmap
 import os
+import shutil
 import struct
 import sys
-
-from PIL import Image
+import time
+import zlib
 
 version = 1.0
 
+# pillow, astc_decomp and liblzfse are imported by load_decoders() on first
+# use, so that importing this module, or header only work, is fast.
+Image = None
+liblzfse = None
+
+def load_decoders():
+    '''Imports the decoding libraries into module globals, if not done already'''
+    global Image, liblzfse
+    if Image is None:
+        import astc_decomp # registers the 'astc' decoder with pillow
+        import liblzfse as _liblzfse
+        from PIL import Image as _Image
+        liblzfse = _liblzfse
+        Image = _Image
+
+# cache_index is only needed with --cache, it is imported by load_cache_index()
+# so that the script runs without it otherwise.
+cache_index = None
+
+def load_cache_index():
+    '''Imports cache_index into module globals, if not done already. If it is not
+       installed, the copy at the root of this repo is used. Raises ImportError if
+       neither is found.'''
+    global cache_index
+    if cache_index is None:
+        try:
+            import cache_index as _cache_index
+        except ImportError:
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'cache_index.py')
+            if not os.path.isfile(path):
+                raise
+            spec = importlib.util.spec_from_file_location('cache_index', path)
+            _cache_index = importlib.util.module_from_spec(spec)
+            spec.loader.exec_module(_cache_index)
+        cache_index = _cache_index
+
+DEFAULT_PREVIEW_SIZE = 256
+ASTC_BLOCK_SIZE = 16 # bytes per 4x4 block
+DEFAULT_CACHE_SIZE_MB = 1024
+CACHE_LOCK_TIMEOUT = 600 # seconds after which a lock left by another worker is ignored
+DEFAULT_BAND_ROWS = 64 # rows of blocks decoded at a time in tiled mode
+
+OUTPUT_EXTENSIONS = { 'png': '.png', 'rgba': '.rgba', 'bmp': '.bmp', 'jpeg': '.jpg', 'webp': '.webp' }
+PNG_STRATEGIES = { 'default': zlib.Z_DEFAULT_STRATEGY, 'filtered': zlib.Z_FILTERED, 
+                   'huffman': zlib.Z_HUFFMAN_ONLY, 'rle': zlib.Z_RLE, 'fixed': zlib.Z_FIXED }
+TIMING_STAGES = ('read', 'lzfse', 'astc', 'encode', 'write')
+
+def get_encoder(output_format='png', level=None, strategy=None, quality=None, fast=False):
+    '''Returns dict of encoder settings used by the convert functions, 
+       None values are left for the encoder (or preset) to choose.
+    '''
+    if fast:
+        level = 1 if level is None else level
+        strategy = strategy or 'rle'
+    return { 'format': output_format, 'level': level, 'strategy': strategy, 
+             'quality': quality, 'fast': fast }
+
+def add_time(timings, stage, start):
+    '''Adds time elapsed since start (a time.perf_counter() value) to timings[stage],
+       returns current time, so that calls can be chained.
+    '''
+    now = time.perf_counter()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + now - start
+    return now
+
+def encode_image(img, encoder, default_level=None):
+    '''Returns PIL image encoded as bytes as per encoder settings (see get_encoder),
+       default_level is PNG compression level to use if encoder does not set one,
+       None leaves it to Pillow.
+    '''
+    output_format = encoder['format']
+    if output_format == 'rgba':
+        return img.tobytes()
+    out = io.BytesIO()
+    if output_format == 'png':
+        params = {}
+        level = default_level if encoder['level'] is None else encoder['level']
+        if level is not None:
+            params['compress_level'] = level
+        if encoder['strategy']:
+            params['compress_type'] = PNG_STRATEGIES[encoder['strategy']]
+        img.save(out, 'PNG', **params)
+    elif output_format == 'jpeg':
+        img.convert('RGB').save(out, 'JPEG', quality=encoder['quality'] or 90)
+    elif output_format == 'webp':
+        img.save(out, 'WEBP', quality=encoder['quality'] or 90, method=0 if encoder['fast'] else 4)
+    elif output_format == 'bmp':
+        img.save(out, 'BMP')
+    else:
+        raise ValueError('Unsupported output format ' + output_format)
+    return out.getvalue()
+
+def open_new_file(path):
+    '''Opens path for writing as a new file. An existing file is removed rather 
+       than overwritten, as it may share its data with a cache object (hard linked
+       by older versions of this script).'''
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    return open(path, 'wb')
+
+def save_image(img, save_to_path, encoder, timings=None, default_level=None):
+    '''Encodes and writes image, timing both stages separately'''
+    start = time.perf_counter()
+    data = encode_image(img, encoder or get_encoder(), default_level)
+    start = add_time(timings, 'encode', start)
+    with open_new_file(save_to_path) as f:
+        f.write(data)
+    add_time(timings, 'write', start)
+
+class PNG_stream_writer:
+    '''Writes an 8 bit RGBA PNG file row by row, without holding the whole image.
+       Rows use filter type None and are deflated as they arrive.
+    '''
+    IDAT_SIZE = 0x10000
+
+    def __init__(self, path, width, height, compress_level=6, strategy=zlib.Z_DEFAULT_STRATEGY, timings=None):
+        self.width = width
+        self.height = height
+        self.rows_written = 0
+        self.timings = timings
+        self.compressor = zlib.compressobj(compress_level, zlib.DEFLATED, zlib.MAX_WBITS, 8, strategy)
+        self.pending = []
+        self.pending_size = 0
+        self.f = open_new_file(path)
+        self.f.write(b'\x89PNG\r\n\x1a\n')
+        self._write_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+
+    def _write_chunk(self, chunk_type, data):
+        self.f.write(struct.pack('>I', len(data)))
+        self.f.write(chunk_type)
+        self.f.write(data)
+        self.f.write(struct.pack('>I', zlib.crc32(data, zlib.crc32(chunk_type)) & 0xFFFFFFFF))
+
+    def _add_compressed(self, data):
+        if data:
+            self.pending.append(data)
+            self.pending_size += len(data)
+        if self.pending_size >= self.IDAT_SIZE:
+            start = time.perf_counter()
+            self._write_chunk(b'IDAT', b''.join(self.pending))
+            add_time(self.timings, 'write', start)
+            self.pending = []
+            self.pending_size = 0
+
+    def write_rows(self, rgba):
+        '''Appends complete rows, rgba is bytes-like holding width*4 bytes per row'''
+        start = time.perf_counter()
+        stride = self.width * 4
+        rgba = memoryview(rgba)
+        num_rows = len(rgba) // stride
+        if self.rows_written + num_rows > self.height:
+            raise ValueError('More rows than image height')
+        filtered = bytearray(num_rows * (stride + 1)) # each row is prefixed by filter type 0
+        for row in range(num_rows):
+            pos = row * (stride + 1) + 1
+            filtered[pos : pos + stride] = rgba[row * stride : (row + 1) * stride]
+        compressed = self.compressor.compress(filtered)
+        add_time(self.timings, 'encode', start)
+        self._add_compressed(compressed)
+        self.rows_written += num_rows
+
+    def close(self):
+        if self.f is None:
+            return
+        try:
+            if self.rows_written != self.height:
+                raise ValueError(f'Only {self.rows_written} of {self.height} rows were written')
+            self.pending.append(self.compressor.flush())
+            self._write_chunk(b'IDAT', b''.join(self.pending))
+            self._write_chunk(b'IEND', b'')
+        finally:
+            self.discard()
+
+    def discard(self):
+        '''Closes file without completing it'''
+        if self.f is not None:
+            self.f.close()
+            self.f = None
+
 class KTX_reader:
 
     def __init__(self):
@@ -65,7 +304,71 @@ class KTX_reader:
         self.aapl_data_pos = 0
         self.aapl_data_size = 0
         self.aapl_is_compressed = False
+        self.aapl_chunks = [] # (identifier, data offset, data size) of each chunk in file order
+
+        self._mmap = None
+        self._view = None
+        self.timings = {} # seconds spent per stage, see TIMING_STAGES
+
+    def _get_file_view(self, f):
+        '''Returns a memoryview over the whole file. The file is mapped read-only
+           when possible, else (not a real file) it is read into memory once.
+           Slices of it are valid until close() is called.
+        '''
+        if self._view is None:
+            try:
+                self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                self._view = memoryview(self._mmap)
+            except (AttributeError, OSError, ValueError): # no fileno, empty file
+                f.seek(0)
+                self._view = memoryview(f.read())
+        return self._view
+
+    def close(self):
+        '''Releases the file mapping, if any'''
+        if self._view is not None:
+            self._view.release()
+            self._view = None
+        if self._mmap is not None:
+            try:
+                self._mmap.close()
+            except BufferError: # a slice handed out is still alive, mapping goes when it does
+                pass
+            self._mmap = None
+
+    def _lzfse_decompress(self, view):
+        load_decoders()
+        start = time.perf_counter()
+        try:
+            return liblzfse.decompress(view)
+        except TypeError: # pyliblzfse only takes bytes, so this is the only copy of compressed data
+            return liblzfse.decompress(view.tobytes())
+        finally:
+            add_time(self.timings, 'lzfse', start)
+
+    def _astc_decode(self, data, width, height):
+        '''Decodes ASTC 4x4 data into an RGBA image'''
+        load_decoders()
+        start = time.perf_counter()
+        img = Image.frombytes('RGBA', (width, height), data, 'astc', (4, 4, False))
+        add_time(self.timings, 'astc', start)
+        return img
+
+    def validate_header_timed(self, f):
+        start = time.perf_counter()
+        ret = self.validate_header(f)
+        add_time(self.timings, 'read', start)
+        return ret
     
+    def get_content_hash(self, f):
+        '''Returns SHA-256 hex digest of the whole file. The file mapping is kept, 
+           so decoding afterwards does not read the file again.
+        '''
+        start = time.perf_counter()
+        digest = hashlib.sha256(self._get_file_view(f)).hexdigest()
+        add_time(self.timings, 'read', start) # hashing pages in the whole file
+        return digest
+
     def validate_header(self, f):
         '''Reads header and validates version
 
@@ -114,16 +417,21 @@ class KTX_reader:
         return False
 
     def parse_aapl_file(self, f):
-        '''Returns True if HEAD was found and header items could be read'''
+        '''Indexes all chunks of the file in self.aapl_chunks, in a single pass over the
+           mapped file. Returns True if HEAD was found and header items could be read
+        '''
         ret = False
-        next_header_pos = 8
-        f.seek(next_header_pos)
-        data = f.read(8)
-        while data:
-            item_size = struct.unpack('<I', data[0:4])[0]
-            item_identifier = data[4:8]
-            if item_identifier == b'HEAD':
-                item_data = f.read(item_size)
+        view = self._get_file_view(f)
+        file_size = len(view)
+        self.aapl_chunks = []
+        pos = 8
+        while pos + 8 <= file_size:
+            item_size, item_identifier = struct.unpack('<I4s', view[pos : pos + 8])
+            data_pos = pos + 8
+            if data_pos + item_size > file_size: # truncated, keep what is there
+                item_size = file_size - data_pos
+            self.aapl_chunks.append((item_identifier, data_pos, item_size))
+            if item_identifier == b'HEAD' and item_size >= 44:
                 # read metadata here...
                 _, _, _, _, \
                 self.glInternalFormat, \
@@ -133,42 +441,68 @@ class KTX_reader:
                 self.pixelDepth, \
                 self.numberOfArrayElements, \
                 self.numberOfFaces = \
-                    struct.unpack('<11I', item_data[0:44])
+                    struct.unpack('<11I', view[data_pos : data_pos + 44])
                 ret = True
-            elif item_identifier == b'LZFS':
-                self.aapl_data_pos = f.tell() + 4
-                self.aapl_data_size = item_size - 4
-                self.aapl_is_compressed = True
-            elif item_identifier == b'astc':
-                self.aapl_data_pos = f.tell() + 4
-                self.aapl_data_size = item_size - 4
-            next_header_pos += 8 + item_size
-            f.seek(next_header_pos)
-            data = f.read(8)
+            elif item_identifier in (b'LZFS', b'astc') and item_size >= 4:
+                if not self.aapl_data_pos: # first payload chunk
+                    self.aapl_data_pos = data_pos + 4
+                    self.aapl_data_size = item_size - 4
+                if item_identifier == b'LZFS':
+                    self.aapl_is_compressed = True
+            pos = data_pos + item_size
         return ret
 
+    def get_aapl_payload_chunks(self):
+        '''Returns list of (identifier, offset, size) of texture data in LZFS and astc
+           chunks, in file order. The 4 bytes at the start of each chunk are skipped.
+        '''
+        return [(identifier, data_pos + 4, size - 4) for identifier, data_pos, size in self.aapl_chunks
+                    if identifier in (b'LZFS', b'astc') and size >= 4]
+
+    def get_compression(self, f):
+        '''Returns compression of texture data as 'lzfse', 'none' or 'unknown'.
+           Only reads the key-value data and the start of texture data.
+           Call after validate_header().
+        '''
+        if self.is_aapl_file:
+            return 'lzfse' if self.aapl_is_compressed else 'none'
+        f.seek(0x40)
+        k_v_data = f.read(self.bytesOfKeyValueData)
+        if k_v_data.find(b'Compression_APPLE') < 0:
+            return 'none'
+        if f.read(16)[12:15] == b'bvx':
+            return 'lzfse'
+        return 'unknown'
+
     def get_uncompressed_texture_data(self, f):
         '''Just read the texture data which is lzfse compressed, uncompress and return it.
+            The file is mapped and not read, so uncompressed texture data is returned 
+            as a memoryview into the file (valid until close()), decompressed data 
+            as bytes.
             Exceptions raised are ValueError or liblzfse.error
         '''
         if self.glInternalFormat == 0x93B0:
+            view = self._get_file_view(f)
             if self.is_aapl_file:
-                f.seek(self.aapl_data_pos)
-                data = f.read(self.aapl_data_size)
-                if self.aapl_is_compressed:
-                    decompressed = liblzfse.decompress(data)
-                    return decompressed
-                else:
-                    return data
+                parts = []
+                for identifier, data_pos, size in self.get_aapl_payload_chunks():
+                    data = view[data_pos : data_pos + size]
+                    if identifier == b'LZFS':
+                        parts.append(self._lzfse_decompress(data))
+                    else:
+                        parts.append(data)
+                if not parts:
+                    raise ValueError('No texture data found')
+                if len(parts) == 1:
+                    return parts[0]
+                return b''.join(parts) # texture split over several chunks
             else:
-                f.seek(0x40)
-                k_v_data = f.read(self.bytesOfKeyValueData)
+                k_v_data = view[0x40 : 0x40 + self.bytesOfKeyValueData].tobytes()
                 compressed = True if k_v_data.find(b'Compression_APPLE') >= 0 else False
-                f.seek(0x40 + self.bytesOfKeyValueData)
-                data = f.read()
+                data = view[0x40 + self.bytesOfKeyValueData:]
                 if compressed:
                     if data[12:15] == b'bvx':
-                        decompressed = liblzfse.decompress(data[12:])
+                        decompressed = self._lzfse_decompress(data[12:])
                         return decompressed
                     else:
                         raise ValueError('Unsupported compression, not lzfse!')
@@ -178,7 +512,7 @@ class KTX_reader:
             raise ValueError('Unsupported Format')
         return b''
 
-    def convert_to_png(self, f, save_to_path):
+    def convert_to_png(self, f, save_to_path, encoder=None):
         # using astc_decomp
         '''Exports KTX as a PNG file
             Arguments
@@ -188,6 +522,9 @@ class KTX_reader:
             save_to_path : Path of file to save to. If file exists, it will be 
             overwritten.
 
+            encoder      : Output format and compression settings from 
+            get_encoder(), default is PNG.
+
             Returns
             -------
             Bool : True if file was successfully exported else False
@@ -196,52 +533,550 @@ class KTX_reader:
             ----------
             OSError, ValueError, liblzfse.error
         '''
-        if self.validate_header(f):
-            data = self.get_uncompressed_texture_data(f)
-            dec_img = Image.frombytes('RGBA', (self.pixelWidth, self.pixelHeight), data, 'astc', (4, 4, False))
-            dec_img.save(save_to_path, "PNG")
+        if self.validate_header_timed(f):
+            try:
+                data = self.get_uncompressed_texture_data(f)
+                dec_img = self._astc_decode(data, self.pixelWidth, self.pixelHeight)
+                del data # free decompressed buffer (or view on file) before encoding
+                self.close()
+                save_image(dec_img, save_to_path, encoder, self.timings)
+            finally:
+                self.close()
             return True
         return False
     
+    def convert_to_png_tiled(self, f, save_to_path, band_rows=DEFAULT_BAND_ROWS, encoder=None):
+        '''Exports KTX as a PNG file like convert_to_png(), but decodes band_rows rows
+           of 4x4 blocks at a time and streams them to the file. Peak memory is the
+           (decompressed) texture data plus one band, instead of the whole image.
+           Only 'png' and 'rgba' encoder formats can be streamed.
+
+            Returns
+            -------
+            Bool : True if file was successfully exported else False
+        
+            Raises
+            ----------
+            OSError, ValueError, liblzfse.error
+        '''
+        encoder = encoder or get_encoder()
+        if encoder['format'] not in ('png', 'rgba'):
+            raise ValueError('Tiled mode can only write png or rgba')
+        if self.validate_header_timed(f):
+            writer = None
+            raw_file = None
+            try:
+                data = self.get_uncompressed_texture_data(f)
+                width, height = self.pixelWidth, self.pixelHeight
+                band_size = ((width + 3) // 4) * ASTC_BLOCK_SIZE * band_rows
+                band_height = 4 * band_rows
+                if encoder['format'] == 'png':
+                    level = 6 if encoder['level'] is None else encoder['level']
+                    writer = PNG_stream_writer(save_to_path, width, height, level, 
+                                               PNG_STRATEGIES[encoder['strategy'] or 'default'], self.timings)
+                else:
+                    raw_file = open_new_file(save_to_path)
+                for top in range(0, height, band_height):
+                    band_index = top // band_height
+                    band = data[band_index * band_size : (band_index + 1) * band_size]
+                    band_img = self._astc_decode(band, width, min(band_height, height - top))
+                    if writer:
+                        writer.write_rows(band_img.tobytes())
+                    else:
+                        start = time.perf_counter()
+                        raw_file.write(band_img.tobytes())
+                        add_time(self.timings, 'write', start)
+                del data, band
+                if writer:
+                    writer.close()
+            finally:
+                if writer:
+                    writer.discard() # no-op if closed normally
+                if raw_file:
+                    raw_file.close()
+                self.close()
+            return True
+        return False
+
+    def get_mip_level_sizes(self):
+        '''Returns list of (width, height, data size) of all mipmap levels'''
+        sizes = []
+        width, height = self.pixelWidth, self.pixelHeight
+        for _ in range(max(1, self.numberOfMipmapLevels)):
+            sizes.append((width, height, ((width + 3) // 4) * ((height + 3) // 4) * ASTC_BLOCK_SIZE))
+            width, height = max(1, width // 2), max(1, height // 2)
+        return sizes
+
+    def get_mip_level_data(self, data, max_size):
+        '''From uncompressed texture data, returns (width, height, data) of the smallest
+           mipmap level that is still at least max_size pixels on its longer side.
+           Levels follow each other, with or without a 4 byte imageSize before each.
+        '''
+        sizes = self.get_mip_level_sizes()
+        width, height, size = sizes[0]
+        offset = 0
+        for next_width, next_height, next_size in sizes[1:]:
+            if max(next_width, next_height) < max_size:
+                break
+            next_offset = offset + size
+            if data[next_offset : next_offset + 4] == struct.pack('<I', next_size):
+                next_offset += 4
+            if next_offset + next_size > len(data):
+                break
+            width, height, size, offset = next_width, next_height, next_size, next_offset
+        return width, height, data[offset : offset + size]
+
+    @staticmethod
+    def sample_blocks(data, width, height, step):
+        '''Returns (width, height, data) of an ASTC 4x4 image made of every step-th block
+           in both directions, which decodes step*step times faster.
+        '''
+        if step <= 1:
+            return width, height, data
+        blocks_wide = (width + 3) // 4
+        blocks_high = (height + 3) // 4
+        row_size = blocks_wide * ASTC_BLOCK_SIZE
+        columns = range(0, blocks_wide, step)
+        sampled = []
+        for block_row in range(0, blocks_high, step):
+            row = data[block_row * row_size : (block_row + 1) * row_size]
+            sampled.extend(row[col * ASTC_BLOCK_SIZE : (col + 1) * ASTC_BLOCK_SIZE] for col in columns)
+        return len(columns) * 4, len(range(0, blocks_high, step)) * 4, b''.join(sampled)
+
+    def convert_to_preview(self, f, save_to_path, max_size=DEFAULT_PREVIEW_SIZE, encoder=None):
+        '''Exports a thumbnail of the KTX as a PNG file, no bigger than max_size 
+           on either side. Uses the smallest sufficient mipmap level, and only 
+           decodes a sparse subset of blocks if that level is still much bigger.
+           PNG previews use compression level 1 unless encoder sets one.
+
+            Returns
+            -------
+            Bool : True if file was successfully exported else False
+        
+            Raises
+            ----------
+            OSError, ValueError, liblzfse.error
+        '''
+        if self.validate_header_timed(f):
+            try:
+                data = self.get_uncompressed_texture_data(f)
+                width, height, level_data = self.get_mip_level_data(data, max_size)
+                step = max(1, max(width, height) // (2 * max_size))
+                width, height, level_data = self.sample_blocks(level_data, width, height, step)
+                dec_img = self._astc_decode(level_data, width, height)
+                del data, level_data
+                self.close()
+                # Sampled image is whole blocks, so size to the original aspect ratio
+                ratio = min(1.0, max_size / max(self.pixelWidth, self.pixelHeight, 1))
+                preview_size = (max(1, round(self.pixelWidth * ratio)), max(1, round(self.pixelHeight * ratio)))
+                if dec_img.size != preview_size:
+                    start = time.perf_counter()
+                    dec_img = dec_img.resize(preview_size, Image.BILINEAR, reducing_gap=2.0)
+                    add_time(self.timings, 'encode', start)
+                save_image(dec_img, save_to_path, encoder, self.timings, default_level=1)
+            finally:
+                self.close()
+            return True
+        return False
+
     def save_uncompressed_texture(self, f, save_to_path):
         if self.validate_header(f):
-            data = self.get_uncompressed_texture_data(f)
-            f = open(save_to_path, 'wb')
-            f.write(data)
-            f.close()
+            try:
+                data = self.get_uncompressed_texture_data(f)
+                with open_new_file(save_to_path) as out:
+                    out.write(data)
+                del data
+            finally:
+                self.close()
             return True
         return False
 
+KTX_SIGNATURE = b'\xabKTX'
+AAPL_SIGNATURE = b'AAPL\x0D\x0A\x1A\x0A'
+
+INDEX_FIELDS = ('Path', 'Size', 'Modified', 'Container', 'Width', 'Height', 'Format', 
+                'MipmapLevels', 'Compression', 'Supported', 'Error')
+KNOWN_FORMATS = { 0x93B0: 'ASTC_4x4' }
+
+def is_ktx_or_aapl_signature(signature):
+    return signature[0:4] == KTX_SIGNATURE or signature[0:8] == AAPL_SIGNATURE
+
+def is_ktx_or_aapl_file(path):
+    '''Returns True if file at path begins with a KTX or AAPL signature'''
+    try:
+        with open(path, 'rb') as f:
+            signature = f.read(8)
+    except OSError:
+        return False
+    return is_ktx_or_aapl_signature(signature)
+
+def iter_files(folder):
+    '''Walks folder recursively with os.scandir, yielding DirEntry for each file'''
+    pending = [folder]
+    while pending:
+        try:
+            with os.scandir(pending.pop()) as it:
+                for entry in it:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            pending.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield entry
+                    except OSError:
+                        pass
+        except OSError as ex:
+            print(f'Could not list folder - {get_path_text(str(ex))}')
+
+def find_ktx_files(folder):
+    '''Walks folder recursively and returns list of paths of KTX/AAPL files'''
+    found = [entry.path for entry in iter_files(folder) if is_ktx_or_aapl_file(entry.path)]
+    found.sort()
+    return found
+
+def read_ktx_metadata(f):
+    '''Reads only headers of KTX/AAPL file and returns dict of INDEX_FIELDS
+       (except Path, Size, Modified) or None if this is not a KTX/AAPL file
+    '''
+    signature = f.read(8)
+    if not is_ktx_or_aapl_signature(signature):
+        return None
+    ktx = KTX_reader()
+    info = { 'Container': 'AAPL' if signature == AAPL_SIGNATURE else 'KTX', 'Width': '', 'Height': '',
+             'Format': '', 'MipmapLevels': '', 'Compression': '', 'Supported': False, 'Error': ''}
+    try:
+        if ktx.validate_header(f):
+            compression = ktx.get_compression(f)
+            info['Width'] = ktx.pixelWidth
+            info['Height'] = ktx.pixelHeight
+            info['Format'] = KNOWN_FORMATS.get(ktx.glInternalFormat, f'0x{ktx.glInternalFormat:04X}')
+            info['MipmapLevels'] = ktx.numberOfMipmapLevels if not ktx.is_aapl_file else ''
+            info['Compression'] = compression
+            info['Supported'] = ktx.glInternalFormat in KNOWN_FORMATS and compression != 'unknown'
+        else:
+            info['Error'] = ktx.error_message if ktx.error_message else 'Could not read header'
+    except (struct.error, OSError) as ex:
+        info['Error'] = f'Corrupt header - {str(ex)}'
+    finally:
+        ktx.close()
+    return info
+
+def get_path_text(path):
+    '''Returns path (or message with a path) as it can go in the utf8 inventory'''
+    return os.fsencode(path).decode('utf-8', 'backslashreplace')
+
+def index_folder(input_folder, index_path):
+    '''Writes inventory of all KTX/AAPL files under input_folder to index_path
+       as CSV (or JSON if index_path ends in .json). Returns number of files indexed.
+    '''
+    items = []
+    for entry in iter_files(input_folder):
+        try:
+            with open(entry.path, 'rb') as f:
+                info = read_ktx_metadata(f)
+            if info is None:
+                continue
+            stat = entry.stat(follow_symlinks=False)
+        except OSError as ex:
+            print(f'Failed {get_path_text(entry.path)} : {get_path_text(str(ex))}')
+            continue
+        info['Path'] = get_path_text(entry.path)
+        info['Size'] = stat.st_size
+        info['Modified'] = datetime.datetime.fromtimestamp(stat.st_mtime, datetime.timezone.utc).strftime('%Y-%m-%d %H:%M:%S')
+        items.append({field: info[field] for field in INDEX_FIELDS})
+    items.sort(key=lambda x: x['Path'])
+    if index_path.lower().endswith('.json'):
+        with open(index_path, 'w', encoding='utf8') as out:
+            json.dump(items, out, indent=1)
+    else:
+        with open(index_path, 'w', newline='', encoding='utf8') as out:
+            writer = csv.DictWriter(out, fieldnames=INDEX_FIELDS)
+            writer.writeheader()
+            writer.writerows(items)
+    return len(items)
+
+def get_output_extension(options):
+    extension = OUTPUT_EXTENSIONS[options['encoder']['format']] if options.get('encoder') else '.png'
+    return '.preview' + extension if options.get('preview_size') else extension
+
+def get_output_path(ktx_path, input_folder, output_folder, flat, extension='.png'):
+    '''Returns the path of the png to create for ktx_path, creating parent folders'''
+    if not output_folder:
+        return ktx_path + extension
+    rel_path = os.path.relpath(ktx_path, input_folder)
+    if flat:
+        return os.path.join(output_folder, rel_path.replace(os.sep, '_') + extension)
+    out_path = os.path.join(output_folder, rel_path + extension)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    return out_path
+
+def get_cache_tag(options):
+    '''Returns string identifying the conversion options, part of the cache key'''
+    tag = f'preview{options["preview_size"]}' if options.get('preview_size') else ''
+    encoder = options.get('encoder') or get_encoder()
+    if encoder['format'] == 'png':
+        tag += f'png{"" if encoder["level"] is None else encoder["level"]}{encoder["strategy"] or ""}'
+    elif encoder['format'] in ('jpeg', 'webp'):
+        tag += f'{encoder["format"]}{encoder["quality"] or ""}{"fast" if encoder["fast"] else ""}'
+    else:
+        tag += encoder['format']
+    return tag
+
+def copy_replace(source, dest):
+    '''Copies source to a new file replacing dest. Never hard linked, so that 
+       outputs and cache objects can't change each other.'''
+    temp_path = dest + '.tmp' + str(os.getpid())
+    try:
+        shutil.copyfile(source, temp_path)
+        os.replace(temp_path, dest)
+    except OSError:
+        try:
+            os.remove(temp_path)
+        except OSError:
+            pass
+        raise
+
+def claim_cache_object(object_path):
+    '''Waits until object_path exists in cache or this process holds its lock file.
+       Returns True if the lock was taken (caller must convert, then release), 
+       False if the object is now available.
+    '''
+    lock_path = object_path + '.lock'
+    os.makedirs(os.path.dirname(object_path), exist_ok=True)
+    while True:
+        if os.path.exists(object_path):
+            return False
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            if os.path.exists(object_path): # published after our check
+                os.remove(lock_path)
+                return False
+            return True
+        except FileExistsError: # a duplicate is being converted by another worker
+            try:
+                if time.time() - os.path.getmtime(lock_path) > CACHE_LOCK_TIMEOUT:
+                    os.remove(lock_path)
+            except OSError:
+                pass
+            time.sleep(0.05)
+
+def convert_file(job):
+    '''Worker for batch conversion, job is (ktx_path, png_path, options) where options
+       is a dict, 'preview_size' set to a number creates a thumbnail of that size,
+       'band_rows' set to a number decodes in bands (tiled) to bound memory,
+       'encoder' is output format and settings from get_encoder() (default PNG),
+       'cache_folder' if set is used to reuse or store the converted image.
+       Returns (ktx_path, png_path, error, info) where error is '' on success and
+       info is a dict with 'timings' (seconds per stage) if file was decoded, and 
+       'cache_key', 'cache_hit' and 'size' if cache is used.
+    '''
+    ktx_path, png_path, options = job
+    load_decoders()
+    info = {}
+    cache_folder = options.get('cache_folder')
+    lock_path = None
+    try:
+        with open(ktx_path, 'rb') as f:
+            ktx = KTX_reader()
+            if cache_folder:
+                load_cache_index()
+                key = ktx.get_content_hash(f) + '_' + get_cache_tag(options) + \
+                      OUTPUT_EXTENSIONS[(options.get('encoder') or get_encoder())['format']]
+                object_path = cache_index.get_cache_object_path(cache_folder, key)
+                info['cache_key'] = key
+                if not claim_cache_object(object_path):
+                    ktx.close()
+                    copy_replace(object_path, png_path)
+                    info['cache_hit'] = True
+                    info['size'] = os.path.getsize(object_path)
+                    return ktx_path, png_path, '', info
+                lock_path = object_path + '.lock'
+            if options.get('preview_size'):
+                converted = ktx.convert_to_preview(f, png_path, options['preview_size'], options.get('encoder'))
+            elif options.get('band_rows'):
+                converted = ktx.convert_to_png_tiled(f, png_path, options['band_rows'], options.get('encoder'))
+            else:
+                converted = ktx.convert_to_png(f, png_path, options.get('encoder'))
+            info['timings'] = ktx.timings
+            if converted:
+                if lock_path:
+                    copy_replace(png_path, object_path)
+                    info['cache_hit'] = False
+                    info['size'] = os.path.getsize(object_path)
+                return ktx_path, png_path, '', info
+            return ktx_path, png_path, 'Conversion to PNG failed ' + ktx.error_message, info
+    except (OSError, ValueError, liblzfse.error) as ex:
+        return ktx_path, png_path, f'Had an exception - {str(ex)}', info
+    except Exception as ex: # astc/pillow decoder errors should not stop the batch
+        return ktx_path, png_path, f'Had an exception - {type(ex).__name__}: {str(ex)}', info
+    finally:
+        if lock_path:
+            try:
+                os.remove(lock_path)
+            except OSError:
+                pass
+
+def add_timings(total, timings):
+    for stage, seconds in timings.items():
+        total[stage] = total.get(stage, 0.0) + seconds
+
+def print_timings(timings):
+    total = sum(timings.values())
+    print('Time spent per stage (summed over all files):')
+    for stage in TIMING_STAGES:
+        seconds = timings.get(stage, 0.0)
+        percent = 100 * seconds / total if total else 0
+        print(f'  {stage:<8}{seconds:10.3f} s {percent:6.1f} %')
+
+def get_path_hash(path):
+    '''Returns a short hash of the absolute path, to tell apart outputs with the same name'''
+    return hashlib.sha1(os.fsencode(os.path.abspath(path))).hexdigest()[:8]
+
+def convert_folder(input_folder, output_folder, flat, workers, options, cache=None, timings=None):
+    '''Converts all KTX/AAPL files under input_folder in parallel,
+       Returns (number of files converted, number that failed)
+       If timings (dict) is given, time per stage from all workers is added to it.
+    '''
+    ktx_paths = find_ktx_files(input_folder)
+    if not ktx_paths:
+        print('No KTX files found in ' + input_folder)
+        return 0, 0
+    if output_folder:
+        os.makedirs(output_folder, exist_ok=True)
+    extension = get_output_extension(options)
+    jobs = [(path, get_output_path(path, input_folder, output_folder, flat, extension), options) for path in ktx_paths]
+    if flat: # joining path parts with '_' can clash, eg: a_b/c.ktx and a/b_c.ktx
+        used_names = set()
+        for index, (path, out_path, _) in enumerate(jobs):
+            if out_path.lower() in used_names:
+                out_path = out_path[:-len(extension)] + '_' + get_path_hash(path) + extension
+                jobs[index] = (path, out_path, options)
+            used_names.add(out_path.lower())
+    print(f'Converting {len(jobs)} files')
+    converted = 0
+    failed = 0
+    chunk_size = max(1, min(32, len(jobs) // ((workers or os.cpu_count() or 1) * 4)))
+    from concurrent.futures import ProcessPoolExecutor
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for ktx_path, png_path, error, info in executor.map(convert_file, jobs, chunksize=chunk_size):
+            if cache:
+                cache.record(info)
+            if timings is not None:
+                add_timings(timings, info.get('timings', {}))
+            if error:
+                failed += 1
+                print(f'Failed {ktx_path} : {error}')
+            else:
+                converted += 1
+    return converted, failed
+
 def main():
     if sys.argv[0].lower().endswith('.exe'):
         executor = os.path.basename(sys.argv[0])
     else:
         executor = 'python3 ' + os.path.basename(sys.argv[0])
-    usage = '\nios_ktx2png ver {0} - converts ios created KTX to PNG\n' + \
-            '  (c) 2020 Yogesh Khatri MIT License\n\n' + \
-            'Usage:\n-----\n  {1} SAMPLE.KTX\n\n' + \
-            'Output will be stored as SAMPLE.KTX.png in same folder\n'
-    usage = usage.format(version, executor)
-    argc = len(sys.argv)
-    if argc < 2:
+    description = f'ios_ktx2png ver {version} - converts ios created KTX to PNG\n' + \
+                   '  (c) 2020 Yogesh Khatri MIT License'
+    epilog = 'A single file is stored as SAMPLE.KTX.png in same folder. For a folder, all KTX\n' + \
+             'files under it are converted in parallel, output is stored next to each file\n' + \
+             'unless an output folder is given.'
+    parser = argparse.ArgumentParser(prog=executor, description=description, epilog=epilog,
+                                     formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('input_path', help='Path to KTX file or folder to process recursively')
+    parser.add_argument('-o', '--output', help='Output folder (folder mode only), source tree is mirrored here')
+    parser.add_argument('--flat', action='store_true', help='Write all output files directly in output folder, '
+                                                              'names that clash get a short hash of the path added')
+    parser.add_argument('-w', '--workers', type=int, default=None, 
+                        help='Number of worker processes (default is number of cpus)')
+    parser.add_argument('--preview', action='store_true', help='Create fast thumbnails instead of full size images')
+    parser.add_argument('--preview-size', metavar='MAX_SIZE', type=int, default=DEFAULT_PREVIEW_SIZE,
+                        help=f'Thumbnail size in pixels on longer side (default {DEFAULT_PREVIEW_SIZE})')
+    parser.add_argument('--tiled', action='store_true', help='Decode and write in bands, for huge textures')
+    parser.add_argument('--band-rows', metavar='N', type=int, default=DEFAULT_BAND_ROWS,
+                        help=f'Rows of 4x4 blocks per band in tiled mode (default {DEFAULT_BAND_ROWS})')
+    parser.add_argument('--format', choices=list(OUTPUT_EXTENSIONS), default='png', help='Output format (default png)')
+    parser.add_argument('--level', type=int, choices=range(10), metavar='0-9', help='PNG compression level')
+    parser.add_argument('--strategy', choices=list(PNG_STRATEGIES), help='PNG zlib compression strategy')
+    parser.add_argument('--quality', type=int, choices=range(1, 101), metavar='1-100', help='JPEG/WebP quality')
+    parser.add_argument('--fast', action='store_true', help='Use fastest encoder settings')
+    parser.add_argument('--timing', action='store_true', help='Print time spent per stage')
+    parser.add_argument('--cache', metavar='CACHE_FOLDER', help='Reuse images converted earlier, kept in this folder')
+    parser.add_argument('--cache-size', metavar='MB', type=int, default=DEFAULT_CACHE_SIZE_MB,
+                        help=f'Maximum cache size in MB (default {DEFAULT_CACHE_SIZE_MB})')
+    parser.add_argument('--index', metavar='INVENTORY', 
+                        help='Only read headers and write inventory to this CSV (or .json) file')
+    if len(sys.argv) < 2:
         print('Exiting.. Not enough arguments. See usage below.')
-        print(usage)
+        parser.print_help()
+        return
+    args = parser.parse_args()
+
+    ktx_path = args.input_path
+    if args.preview_size < 1:
+        print('Error, preview size must be 1 or more')
+        return
+    if args.band_rows < 1:
+        print('Error, band rows must be 1 or more')
         return
-    elif ('-h' in sys.argv) or ('--help' in sys.argv):
-        print(usage)
+    if args.cache_size < 0:
+        print('Error, cache size can\'t be negative')
         return
+    if args.index:
+        if not os.path.isdir(ktx_path):
+            print('Error, --index needs a folder as input')
+            return
+        count = index_folder(ktx_path, args.index)
+        print(f'Done, indexed {count} files. Output is at {args.index}')
+        return
+    from PIL import features
+    if args.format == 'webp' and not features.check('webp'):
+        print('Error, this Pillow was built without WebP support')
+        return
+    if args.tiled and args.format not in ('png', 'rgba') and not args.preview:
+        print('Error, --tiled can only write png or rgba')
+        return
+    if args.cache:
+        try:
+            load_cache_index()
+        except ImportError:
+            print('Error, --cache needs cache_index.py, copy it from the root folder of this repo '
+                  'next to this script (or one folder up)')
+            return
+    options = { 'preview_size': args.preview_size if args.preview else None,
+                'band_rows': args.band_rows if args.tiled else None,
+                'encoder': get_encoder(args.format, args.level, args.strategy, args.quality, args.fast),
+                'cache_folder': os.path.abspath(args.cache) if args.cache else None }
+    if os.path.isdir(ktx_path):
+        if args.flat and not args.output:
+            print('Error, --flat needs an output folder (-o)')
+            return
+        if args.workers is not None and args.workers < 1:
+            print('Error, number of workers must be 1 or more')
+            return
+        cache = cache_index.CacheIndex(options['cache_folder'], args.cache_size * 1024 * 1024) if args.cache else None
+        timings = {} if args.timing else None
+        try:
+            converted, failed = convert_folder(ktx_path, args.output, args.flat, args.workers, options, cache, timings)
+        finally:
+            if cache:
+                cache.close()
+        print(f'Done, converted {converted} files, {failed} failed.')
+        if cache:
+            print(f'Cache had {cache.hits} hits, {cache.misses} misses')
+        if args.timing:
+            print_timings(timings)
     else:
-        ktx_path = sys.argv[1]
-        with open(ktx_path, 'rb') as f:
-            ktx = KTX_reader()
-            #ktx.save_uncompressed_texture(f, ktx_path + '.astc') # If you wish to inspect raw data
-            try:
-                if ktx.convert_to_png(f, ktx_path + '.png'):
-                    print(f'Conversion successful!\nOutput is at {ktx_path}.png')
-                else:
-                    print('Conversion to PNG failed ' + (ktx.error_message if ktx.error_message else ''))
-            except (OSError, ValueError, liblzfse.error) as ex:
-                print(f'Had an exception - {str(ex)}')
+        #KTX_reader().save_uncompressed_texture(f, ktx_path + '.astc') # If you wish to inspect raw data
+        cache = cache_index.CacheIndex(options['cache_folder'], args.cache_size * 1024 * 1024) if args.cache else None
+        _, out_path, error, info = convert_file((ktx_path, ktx_path + get_output_extension(options), options))
+        if cache:
+            cache.record(info)
+            cache.close()
+        if error:
+            print(error)
+        else:
+            print(f'Conversion successful!\nOutput is at {out_path}')
+        if args.timing:
+            print_timings(info.get('timings', {}))
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -30,9 +30,36 @@
 #                registry.
 #
 #                Usage:
-#                Read_OfficeRegDB.py <path to microsoftRegistrationDB.reg> <output folder>
+#                Read_OfficeRegDB.py [-b <max inline bytes>] <path to microsoftRegistrationDB.reg> <output folder>
 #                Example: Read_OfficeRegDB.py  c:\microsoftRegistrationDB.reg c:\output
 #
+#                With -b, REG_BINARY values larger than the given size are not written
+#                out in full. Each distinct value is saved once to the officeregdb_blobs
+#                folder, named by its sha256 hash, and the CSV and plist only reference
+#                the hash. The CSV also shows the first few bytes in hex.
+#
+#                To look up a single key, subtree or value without exporting the whole
+#                database, use the query mode. It builds a path index (saved to the 
+#                -i path if provided, and reused on later runs) and prints matching
+#                rows in the same tab-delimited format as the CSV:
+#                Read_OfficeRegDB.py query [-i <index file>] <path to db> get <key path>
+#                Read_OfficeRegDB.py query [-i <index file>] <path to db> list <key path prefix>
+#                Read_OfficeRegDB.py query [-i <index file>] <path to db> search <value regex>
+#                Example: Read_OfficeRegDB.py query c:\microsoftRegistrationDB.reg list 
+#                           "Software\Microsoft\Office\16.0\Word\File MRU"
+#
+#                To see what changed between two copies of the database (say from two
+#                acquisitions), use the diff mode. Only added, removed and modified keys
+#                and values are written out, to officeregdb_diff.csv in the output folder:
+#                Read_OfficeRegDB.py diff <older db> <newer db> <output folder>
+#
+#                To process every registration db found under one or more image roots
+#                (all users, all Office group containers), use the batch mode. Files are
+#                processed in parallel, by default one worker process per cpu. Output files
+#                are named after the source, eg: img1_Users_bob_..._UBF8T346G9.Office.officeregdb.csv,
+#                or with -c, all rows go into one officeregdb_combined.csv with a Source column.
+#                Read_OfficeRegDB.py batch [-c] [-w <workers>] [-b <max inline bytes>] <output folder> <image root> [<image root> ..]
+#
 # Requirements:  Python (2 or 3), biplist and recent version of sqlite3
 #                If you get an error realated to sqlite, you will need a recent (or latest)
 #                version of sqlite3 from  https://sqlite.org/download.html . Copy the 
@@ -45,14 +72,40 @@
 
 import sqlite3
 import sys
-from biplist import *
 import datetime
 import binascii
 import struct
 import os
 import codecs
+import re
+import hashlib
+# biplist, multiprocessing and urllib are imported where needed, as they take
+# longer to load than everything else, and most runs don't need all of them.
+
+PYTHON_VER = sys.version_info.major
+
+# Walks the key tree down from 'Software', building the full path of every key
+KEY_PATHS_QUERY = str(" WITH RECURSIVE "
+                    "   under_software(path, name, node_id, write_time) AS ( "
+                    "     VALUES('Software','',1, 0) "
+                    "     UNION ALL "
+                    "     SELECT under_software.path || '\\' || HKEY_CURRENT_USER.name, HKEY_CURRENT_USER.name, HKEY_CURRENT_USER.node_id, HKEY_CURRENT_USER.write_time "
+                    "       FROM HKEY_CURRENT_USER JOIN under_software ON HKEY_CURRENT_USER.parent_id=under_software.node_id "
+                    "       ORDER BY 1 "
+                    "   ) "
+                    " SELECT name, path, write_time, node_id FROM under_software ")
+
+# All keys with their values, one row per value
+REG_QUERY = str("SELECT  t2.node_id as id, t2.write_time as keyLastWriteTime, path as key, HKEY_CURRENT_USER_values.name as valueName, HKEY_CURRENT_USER_values.value as value, HKEY_CURRENT_USER_values.type as valueType from ( "
+                + KEY_PATHS_QUERY +
+                " ) as t2 LEFT JOIN HKEY_CURRENT_USER_values on HKEY_CURRENT_USER_values.node_id=t2.node_id ")
+
+CSV_HEADER = "ID\tKeyLastWriteTimeUTC\tKey\tValueName\tValue\tValueType\r\n"
+BLOB_PREVIEW_SIZE = 32 # bytes of a stored blob shown in hex in the CSV
+
+REG_DB_NAME = "microsoftregistrationdb.reg" # lowercase, for comparison
 
-PYTHON_VER = 2
+DIFF_CSV_HEADER = "Change\tKey\tValueName\tOldValue\tOldValueType\tNewValue\tNewValueType\tOldKeyLastWriteTimeUTC\tNewKeyLastWriteTimeUTC\r\n"
 
 def GetStringUtcFromFileTimeTS(val):
     t = GetUtcFromFileTimeTS(val)
@@ -72,13 +125,52 @@ def GetUtcFromFileTimeTS(val):
             pass
     return None
 
-def GetStringRepresentation(value, valuetype = None):
+class BlobStore:
+    '''Content-addressed store for large REG_BINARY values. Values longer than threshold
+       are written once to folder\<sha256[:2]>\<sha256> and referred to by hash.'''
+    def __init__(self, folder, threshold):
+        self.folder = folder
+        self.threshold = threshold
+        self.stored = set()
+
+    def IsLarge(self, value):
+        return len(value) > self.threshold
+
+    def Put(self, value):
+        '''Stores value (if not already there) and returns its sha256 hex digest'''
+        digest = hashlib.sha256(value).hexdigest()
+        if digest not in self.stored:
+            path = os.path.join(self.folder, digest[:2], digest)
+            if not os.path.exists(path):
+                if not os.path.isdir(os.path.dirname(path)):
+                    try:
+                        os.makedirs(os.path.dirname(path))
+                    except OSError: # Created by another process meanwhile
+                        if not os.path.isdir(os.path.dirname(path)):
+                            raise
+                tempPath = path + '.%d.tmp' % os.getpid()
+                with open(tempPath, 'wb') as f:
+                    f.write(value)
+                try:
+                    os.rename(tempPath, path)
+                except OSError: # Stored by another process meanwhile
+                    os.remove(tempPath)
+            self.stored.add(digest)
+        return digest
+
+def GetHexString(value):
+    if PYTHON_VER == 2: return binascii.hexlify(value).upper()
+    else:               return binascii.hexlify(value).decode("ascii").upper() # For python3!
+
+def GetStringRepresentation(value, valuetype = None, blobStore = None):
     s = ''
     if value == None:
         return s
     if valuetype == 3:  # REG_BINARY
-        if PYTHON_VER == 2: s = binascii.hexlify(value).upper()
-        else:               s = binascii.hexlify(value).decode("ascii").upper() # For python3!
+        if blobStore and blobStore.IsLarge(value):
+            s = '%s... [%d bytes, blob sha256:%s]' % (GetHexString(value[:BLOB_PREVIEW_SIZE]), len(value), blobStore.Put(value))
+        else:
+            s = GetHexString(value)
     elif valuetype == 1: #REG_SZ
         s = value
     else:
@@ -105,6 +197,11 @@ def GetStringValueType(valuetype):
         s = str(value)
     return s
 
+def GetCsvLine(row, blobStore = None):
+    return '%d\t%s\t%s\t%s\t%s\t%s\r\n' % (row['id'], GetStringUtcFromFileTimeTS(row['keyLastWriteTime']), 
+                GetStringRepresentation(row['key']), GetStringRepresentation(row['valueName']), 
+                GetStringRepresentation(row['value'],row['valueType'], blobStore), GetStringValueType(row['valueType']))
+
 def GetBranch(plist, key):
     path = key.split("\\")
     subkey = plist
@@ -122,7 +219,7 @@ def GetBranch(plist, key):
             subkey = temp
     return subkey
 
-def CreatePListFromData(data):
+def CreatePListFromData(data, blobStore = None):
     # plist = {'HKCU':  
     #             {'SOFTWARE' : 
     #                 {'MICROSOFT' : 
@@ -147,8 +244,11 @@ def CreatePListFromData(data):
             key = row['key']
             vname = row['valueName']
             vtype = row['valueType'] 
-            if PYTHON_VER == 2 and vtype == 3: # In python2, special handling for Binary
-                value = Data(row['value'])
+            if vtype == 3 and blobStore and row['value'] != None and blobStore.IsLarge(row['value']):
+                value = 'blob sha256:' + blobStore.Put(row['value'])
+            elif PYTHON_VER == 2 and vtype == 3: # In python2, special handling for Binary
+                import biplist
+                value = biplist.Data(row['value'])
             else:
                 value = row['value']
             if value == None: value = ''
@@ -167,11 +267,139 @@ def CreatePListFromData(data):
     return plist
 
 
-def ParseRegistrationDBFile(inputPath, outputPath):
+def GetReadOnlyUri(path):
+    '''Returns an sqlite uri that opens the db at path without write access (python3 only)'''
+    from urllib.request import pathname2url
+    return 'file:' + pathname2url(os.path.abspath(path)) + '?mode=ro'
+
+def OpenDatabaseReadOnly(path):
+    if PYTHON_VER > 2:
+        return sqlite3.connect(GetReadOnlyUri(path), uri=True)
+    return sqlite3.connect(path) # No uri support in python2
+
+class OfficeRegDB:
+    '''Read-only query interface for a microsoftRegistrationDB.reg database.
+
+       Key paths are resolved once into a path index, which is an sqlite db of 
+       its own. If indexPath is given, the index is saved there and reused on 
+       later runs for as long as the source database is unchanged, otherwise 
+       it is built in memory. The source database is never written to.
+
+       All queries return rows with the same columns as the CSV output (id, 
+       keyLastWriteTime, key, valueName, value, valueType). Values are returned
+       raw, use GetStringRepresentation() and GetStringUtcFromFileTimeTS() to
+       decode them, so only the rows actually returned are ever decoded.
+    '''
+    INDEX_VERSION = 2
+
+    SELECT_ROWS = str("SELECT k.node_id as id, k.write_time as keyLastWriteTime, k.path as key, v.name as valueName, v.value as value, v.type as valueType "
+                      " FROM keys k LEFT JOIN value_rows r ON r.node_id=k.node_id "
+                      " LEFT JOIN HKEY_CURRENT_USER_values v ON v.rowid=r.src_rowid ")
+
+    def __init__(self, inputPath, indexPath=None):
+        self.inputPath = inputPath
+        if PYTHON_VER > 2:
+            self.conn = sqlite3.connect(indexPath if indexPath else ':memory:', uri=True)
+            source = GetReadOnlyUri(inputPath)
+        else: # No uri support, the db can't be opened as read-only
+            self.conn = sqlite3.connect(indexPath if indexPath else ':memory:')
+            source = inputPath
+        self.conn.row_factory = sqlite3.Row
+        self.conn.execute("ATTACH DATABASE ? AS src", (source,))
+        if not self._IsIndexCurrent():
+            self._BuildIndex()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        self.conn.close()
 
+    def _GetSourceStamp(self):
+        '''Returns what the index was built from, the resolved source path, its size and 
+           mtime, and a fingerprint of its content. The fingerprint is a hash of the first
+           page, which has the file change counter (at offset 24) that sqlite updates on 
+           every write, along with size and mtime of the -wal file if there is one.'''
+        path = os.path.realpath(self.inputPath)
+        st = os.stat(path)
+        with open(path, 'rb') as f:
+            header = f.read(100)
+            pageSize = struct.unpack('>H', header[16:18])[0] if len(header) == 100 else 0
+            if pageSize == 1:
+                pageSize = 65536
+            f.seek(0)
+            hasher = hashlib.sha1(f.read(max(pageSize, 100)))
+        if os.path.exists(path + '-wal'):
+            walSt = os.stat(path + '-wal')
+            hasher.update(('%d %d' % (walSt.st_size, int(walSt.st_mtime))).encode('ascii'))
+        if isinstance(path, bytes): # sqlite only takes text
+            path = path.decode('utf8', 'replace')
+        elif PYTHON_VER > 2:
+            path = path.encode('utf8', 'surrogateescape').decode('utf8', 'replace')
+        return (self.INDEX_VERSION, path, st.st_size, int(st.st_mtime), hasher.hexdigest())
+
+    def _IsIndexCurrent(self):
+        try:
+            row = self.conn.execute("SELECT version, source_path, source_size, source_mtime, source_fingerprint FROM main.meta").fetchone()
+        except sqlite3.Error: # No index yet
+            return False
+        return row != None and tuple(row) == self._GetSourceStamp()
+
+    def _BuildIndex(self):
+        with self.conn:
+            for table in ('meta', 'keys', 'value_rows'):
+                self.conn.execute("DROP TABLE IF EXISTS main." + table)
+            self.conn.execute("CREATE TABLE main.meta (version INTEGER, source_path TEXT, source_size INTEGER, source_mtime INTEGER, source_fingerprint TEXT)")
+            self.conn.execute("CREATE TABLE main.keys (node_id INTEGER PRIMARY KEY, path TEXT NOT NULL COLLATE NOCASE, write_time BLOB)")
+            self.conn.execute("CREATE TABLE main.value_rows (node_id INTEGER, src_rowid INTEGER)")
+            self.conn.execute("INSERT INTO main.keys SELECT node_id, path, write_time FROM ( " + KEY_PATHS_QUERY + " )")
+            self.conn.execute("INSERT INTO main.value_rows SELECT node_id, rowid FROM src.HKEY_CURRENT_USER_values")
+            self.conn.execute("CREATE INDEX main.keys_path ON keys (path)")
+            self.conn.execute("CREATE INDEX main.value_rows_node ON value_rows (node_id)")
+            self.conn.execute("INSERT INTO main.meta VALUES (?, ?, ?, ?, ?)", self._GetSourceStamp())
+
+    def get(self, path):
+        '''Returns rows for the key at path (one per value), or an empty list if there 
+           is no such key. Paths are case-insensitive, like in the windows registry.'''
+        path = path.strip('\\')
+        return self.conn.execute(self.SELECT_ROWS + " WHERE k.path=?", (path,)).fetchall()
+
+    def list(self, prefix):
+        '''Returns rows for the key at prefix and all keys under it, in path order'''
+        prefix = prefix.strip('\\')
+        # ']' is the character right after '\', so this range covers everything under prefix
+        return self.conn.execute(self.SELECT_ROWS + " WHERE k.path=? OR (k.path>? AND k.path<?) ORDER BY k.path", 
+                                 (prefix, prefix + '\\', prefix + ']')).fetchall()
+
+    def search(self, valueRegex):
+        '''Returns rows for all values whose data matches the regular expression,
+           in path order. REG_BINARY data is not searched.'''
+        pattern = re.compile(valueRegex)
+        def ValueMatches(value, valuetype):
+            if value == None or valuetype == 3:
+                return 0
+            try:
+                return 1 if pattern.search(GetStringRepresentation(value, valuetype)) else 0
+            except TypeError: # Not text
+                return 0
+        self.conn.create_function("value_matches", 2, ValueMatches)
+        return self.conn.execute("SELECT k.node_id as id, k.write_time as keyLastWriteTime, k.path as key, v.name as valueName, v.value as value, v.type as valueType "
+                                 " FROM src.HKEY_CURRENT_USER_values v JOIN keys k ON k.node_id=v.node_id "
+                                 " WHERE value_matches(v.value, v.type) ORDER BY k.path").fetchall()
+
+def ParseRegistrationDBFile(inputPath, outputPath, blobThreshold=None, namePrefix=''):
+    '''Exports the db to officeregdb.csv and officeregdb.plist in outputPath, with namePrefix 
+       prepended to the file names. If blobThreshold is set, REG_BINARY values larger than
+       it go to the officeregdb_blobs folder instead.'''
     try:
-        plistPath = os.path.join(outputPath, "officeregdb.plist")
-        csvPath   = os.path.join(outputPath, "officeregdb.csv")
+        plistPath = os.path.join(outputPath, namePrefix + "officeregdb.plist")
+        csvPath   = os.path.join(outputPath, namePrefix + "officeregdb.csv")
+        blobStore = None
+        if blobThreshold != None:
+            blobStore = BlobStore(os.path.join(outputPath, "officeregdb_blobs"), blobThreshold)
     except Exception as ex:
         print ("Error: Failed to create output paths : " + outputPath + " Error: " + str(ex))
 
@@ -182,38 +410,26 @@ def ParseRegistrationDBFile(inputPath, outputPath):
 
         conn.row_factory = sqlite3.Row
         try:
-            query = str("SELECT  t2.node_id as id, t2.write_time as keyLastWriteTime, path as key, HKEY_CURRENT_USER_values.name as valueName, HKEY_CURRENT_USER_values.value as value, HKEY_CURRENT_USER_values.type as valueType from ( "
-                    " WITH RECURSIVE "
-                    "   under_software(path, name, node_id, write_time) AS ( "
-                    "     VALUES('Software','',1, 0) "
-                    "     UNION ALL "
-                    "     SELECT under_software.path || '\\' || HKEY_CURRENT_USER.name, HKEY_CURRENT_USER.name, HKEY_CURRENT_USER.node_id, HKEY_CURRENT_USER.write_time "
-                    "       FROM HKEY_CURRENT_USER JOIN under_software ON HKEY_CURRENT_USER.parent_id=under_software.node_id "
-                    "       ORDER BY 1 "
-                    "   ) "
-                    " SELECT name, path, write_time, node_id FROM under_software "
-                    " ) as t2 LEFT JOIN HKEY_CURRENT_USER_values on HKEY_CURRENT_USER_values.node_id=t2.node_id ")
-            cursor = conn.execute(query)
+            cursor = conn.execute(REG_QUERY)
             data = cursor.fetchall()
             # Print to file
             print (" Creating file " + csvPath + " for writing")
             try:
                 with codecs.open(csvPath, 'w', encoding='utf-16') as csv:
-                    csv.write("ID\tKeyLastWriteTimeUTC\tKey\tValueName\tValue\tValueType\r\n")
+                    csv.write(CSV_HEADER)
                     for row in data:
-                        csv.write ('%d\t%s\t%s\t%s\t%s\t%s\r\n' % (row['id'], GetStringUtcFromFileTimeTS(row['keyLastWriteTime']), 
-                                    GetStringRepresentation(row['key']), GetStringRepresentation(row['valueName']), 
-                                    GetStringRepresentation(row['value'],row['valueType']), GetStringValueType(row['valueType'])))
+                        csv.write(GetCsvLine(row, blobStore))
                     print (" CSV written out successfully to " + csvPath)
             except Exception as ex:
                 print ("Error writing to csv: ", ex.args )
 
             print (" Creating file " + plistPath + " for writing") 
             try:
-                plist = CreatePListFromData(data)
-                writePlist(plist, plistPath)
+                import biplist
+                plist = CreatePListFromData(data, blobStore)
+                biplist.writePlist(plist, plistPath)
                 print (" Plist written out successfully to " + plistPath)
-            except (InvalidPlistException, NotBinaryPlistException, Exception) as ex:
+            except Exception as ex: # includes ImportError and biplist.InvalidPlistException
                 print ("Error creating the plist: ", ex.args )
 
         except Exception as ex:
@@ -225,44 +441,340 @@ def ParseRegistrationDBFile(inputPath, outputPath):
         conn.close()
 
 
-## Program starts here ##
+def FindRegistrationDBFiles(root):
+    '''Yields paths of all microsoftRegistrationDB.reg files under root'''
+    for folder, _, files in os.walk(root):
+        for name in files:
+            if name.lower() == REG_DB_NAME:
+                yield os.path.join(folder, name)
+
+def GetSourceName(root, path):
+    '''Returns a name for the db at path, built from the root folder name and the path
+       under it, that is safe to use in a file name, eg: img1_Users_bob_Library_Group Containers_UBF8T346G9.Office'''
+    rootName = os.path.basename(os.path.normpath(os.path.abspath(root)))
+    folder = os.path.relpath(os.path.dirname(path), root)
+    parts = [rootName] + [part for part in folder.split(os.sep) if part not in ('', '.')]
+    return re.sub(r'[<>:"/\\|?*]', '_', '_'.join([part for part in parts if part]))
+
+def GetPathHash(path):
+    '''Returns a short hash of the absolute path, to tell apart dbs with the same source name'''
+    path = os.path.abspath(path)
+    if not isinstance(path, bytes):
+        path = path.encode('utf8', 'surrogateescape')
+    return hashlib.sha1(path).hexdigest()[:8]
+
+def ProcessBatchJob(job):
+    '''Runs in a worker process. Exports one db to its own namespaced files, or for 
+       a combined output, returns its CSV lines prefixed with the source name.'''
+    inputPath, sourceName, outputPath, blobThreshold, combined = job
+    if not combined:
+        ParseRegistrationDBFile(inputPath, outputPath, blobThreshold, sourceName + '.')
+        return inputPath, None
+    lines = []
+    conn = None
+    try:
+        blobStore = None
+        if blobThreshold != None:
+            blobStore = BlobStore(os.path.join(outputPath, "officeregdb_blobs"), blobThreshold)
+        conn = OpenDatabaseReadOnly(inputPath)
+        conn.row_factory = sqlite3.Row
+        for row in conn.execute(REG_QUERY):
+            lines.append(sourceName + '\t' + GetCsvLine(row, blobStore))
+    except Exception as ex:
+        print ("Error: Failed to read database : " + inputPath + " Error: " + str(ex))
+        lines = None
+    if conn:
+        conn.close()
+    return inputPath, lines
+
+def ProcessRegistrationDBFilesInBatch(roots, outputPath, blobThreshold=None, combined=False, workers=None):
+    jobs = []
+    usedNames = set()
+    usedRoots = set()
+    for root in roots:
+        if os.path.abspath(root) in usedRoots:
+            continue
+        usedRoots.add(os.path.abspath(root))
+        for path in FindRegistrationDBFiles(root):
+            sourceName = GetSourceName(root, path)
+            if sourceName.lower() in usedNames: # Roots with the same folder name, or a clash after joining with '_'
+                sourceName += '_' + GetPathHash(path)
+            usedNames.add(sourceName.lower())
+            jobs.append((path, sourceName, outputPath, blobThreshold, combined))
+    print ("Found %d registration db files" % len(jobs))
+    if not jobs:
+        return
+
+    csv = None
+    if combined:
+        csvPath = os.path.join(outputPath, "officeregdb_combined.csv")
+        print (" Creating file " + csvPath + " for writing")
+        csv = codecs.open(csvPath, 'w', encoding='utf-16')
+        csv.write("Source\t" + CSV_HEADER)
+    import multiprocessing
+    pool = multiprocessing.Pool(workers if workers else multiprocessing.cpu_count())
+    try:
+        for inputPath, lines in pool.imap_unordered(ProcessBatchJob, jobs):
+            if csv and lines != None:
+                for line in lines:
+                    csv.write(line)
+                print (" Added %d rows from %s" % (len(lines), inputPath))
+    finally:
+        pool.close()
+        pool.join()
+        if csv:
+            csv.close()
+    print ("Finished processing %d files" % len(jobs))
+
+def IterKeys(conn):
+    '''Yields (path, keyLastWriteTime, values, digest) for every key in path order, where
+       values is a dict of {valueName : (valueType, value)} and digest is a hash over
+       the key's timestamp and values, so two keys compare equal if their digests do.'''
+    cursor = conn.execute(REG_QUERY + " ORDER BY key, valueName")
+    path = None
+    for row in cursor:
+        if row['key'] != path:
+            if path != None:
+                yield path, writeTime, values, hasher.digest()
+            path = row['key']
+            writeTime = row['keyLastWriteTime']
+            values = {}
+            hasher = hashlib.sha1(repr(writeTime).encode('utf8'))
+        if row['valueName'] == None and row['valueType'] == None: # Key without values
+            continue
+        values[row['valueName']] = (row['valueType'], row['value'])
+        hasher.update(repr((row['valueName'], row['valueType'], row['value'])).encode('utf8'))
+    if path != None:
+        yield path, writeTime, values, hasher.digest()
+
+def SortValueNames(names):
+    '''Sorts value names, None (a NULL valueName is valid) is placed last'''
+    return sorted(names, key=lambda v: (v is None, v or ''))
+
+def DiffRegistrationDBs(oldPath, newPath):
+    '''Compares two registration databases, yielding a tuple for every change found:
+       (change, key, valueName, oldValueType, oldValue, newValueType, newValue, 
+        oldKeyLastWriteTime, newKeyLastWriteTime)
+       where change is one of KeyAdded, KeyRemoved, KeyModified (timestamp differs),
+       ValueAdded, ValueRemoved or ValueModified. Values of added/removed keys are 
+       reported too. Both databases are read once, side by side in path order, and
+       keys with the same content digest are skipped without comparing values.'''
+    oldConn = OpenDatabaseReadOnly(oldPath)
+    newConn = OpenDatabaseReadOnly(newPath)
+    try:
+        oldConn.row_factory = sqlite3.Row
+        newConn.row_factory = sqlite3.Row
+        oldKeys = IterKeys(oldConn)
+        newKeys = IterKeys(newConn)
+        old = next(oldKeys, None)
+        new = next(newKeys, None)
+        while old != None or new != None:
+            if new == None or (old != None and old[0] < new[0]):
+                path, writeTime, values, _ = old
+                yield ('KeyRemoved', path, '', None, None, None, None, writeTime, None)
+                for name in SortValueNames(values):
+                    yield ('ValueRemoved', path, name) + values[name] + (None, None, writeTime, None)
+                old = next(oldKeys, None)
+            elif old == None or new[0] < old[0]:
+                path, writeTime, values, _ = new
+                yield ('KeyAdded', path, '', None, None, None, None, None, writeTime)
+                for name in SortValueNames(values):
+                    yield ('ValueAdded', path, name, None, None) + values[name] + (None, writeTime)
+                new = next(newKeys, None)
+            else:
+                if old[3] != new[3]: # digests differ
+                    path, oldTime, oldValues, _ = old
+                    _, newTime, newValues, _ = new
+                    if oldTime != newTime:
+                        yield ('KeyModified', path, '', None, None, None, None, oldTime, newTime)
+                    for name in SortValueNames(set(oldValues) | set(newValues)):
+                        oldValue = oldValues.get(name, None)
+                        newValue = newValues.get(name, None)
+                        if oldValue == None:
+                            yield ('ValueAdded', path, name, None, None) + newValue + (oldTime, newTime)
+                        elif newValue == None:
+                            yield ('ValueRemoved', path, name) + oldValue + (None, None, oldTime, newTime)
+                        elif oldValue != newValue:
+                            yield ('ValueModified', path, name) + oldValue + newValue + (oldTime, newTime)
+                old = next(oldKeys, None)
+                new = next(newKeys, None)
+    finally:
+        oldConn.close()
+        newConn.close()
+
+def GetDiffCsvLine(change):
+    name, path, vname, oldType, oldValue, newType, newValue, oldTime, newTime = change
+    return '%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\t%s\r\n' % (name, GetStringRepresentation(path), 
+                GetStringRepresentation(vname), GetStringRepresentation(oldValue, oldType), GetStringValueType(oldType),
+                GetStringRepresentation(newValue, newType), GetStringValueType(newType), 
+                GetStringUtcFromFileTimeTS(oldTime), GetStringUtcFromFileTimeTS(newTime))
+
+def DiffRegistrationDBFiles(oldPath, newPath, outputPath):
+    csvPath = os.path.join(outputPath, "officeregdb_diff.csv")
+    # Written to a temporary file first, so that a failure doesn't leave a partial csv behind
+    tempPath = csvPath + ".tmp"
+    try:
+        print (" Creating file " + csvPath + " for writing")
+        count = 0
+        with codecs.open(tempPath, 'w', encoding='utf-16') as csv:
+            csv.write(DIFF_CSV_HEADER)
+            for change in DiffRegistrationDBs(oldPath, newPath):
+                csv.write(GetDiffCsvLine(change))
+                count += 1
+        if os.path.exists(csvPath): # rename can't replace it on windows
+            os.remove(csvPath)
+        os.rename(tempPath, csvPath)
+        print (" Found %d changes, diff written out successfully to %s" % (count, csvPath))
+    except (sqlite3.Error, OSError, IOError) as ex:
+        print ("Error: Failed to diff databases, error was : " + str(ex))
+    finally:
+        if os.path.exists(tempPath):
+            os.remove(tempPath)
+
+def QueryRegistrationDBFile(inputPath, indexPath, command, argument):
+    try:
+        with OfficeRegDB(inputPath, indexPath) as db:
+            if command == 'get':
+                rows = db.get(argument)
+            elif command == 'list':
+                rows = db.list(argument)
+            else:
+                rows = db.search(argument)
+            sys.stdout.write(CSV_HEADER)
+            for row in rows:
+                sys.stdout.write(GetCsvLine(row))
+    except (sqlite3.Error, re.error, OSError) as ex:
+        print ("Error: Failed to query database : " + inputPath + " Error: " + str(ex))
 
 usage = ("Read_OfficeRegDB.py \n\n"
          "This script parses the file 'microsoftRegistrationDB.reg' found at \n"
          "/Users/research/Library/Group Containers/xxxx.Office/MicrosoftRegistrationDB.reg\n\n"
          "Usage:\n"
-         "Read_OfficeRegDB.py <path to microsoftRegistrationDB.reg> <output folder>\n"
+         "Read_OfficeRegDB.py [-b <max inline bytes>] <path to microsoftRegistrationDB.reg> <output folder>\n"
          "Example: Read_OfficeRegDB.py  c:\\microsoftRegistrationDB.reg c:\\output\n\n"
-         "Output will be a Plist file and a CSV file in the provided folder.\n\n"
+         "Output will be a Plist file and a CSV file in the provided folder.\n"
+         "With -b, REG_BINARY values larger than the given size (in bytes) are stored\n"
+         "once each in the officeregdb_blobs folder, and referenced by sha256 hash.\n\n"
+         "Query mode (prints matching rows only):\n"
+         "Read_OfficeRegDB.py query [-i <index file>] <path to db> get <key path>\n"
+         "Read_OfficeRegDB.py query [-i <index file>] <path to db> list <key path prefix>\n"
+         "Read_OfficeRegDB.py query [-i <index file>] <path to db> search <value regex>\n"
+         " The path index is saved to the -i file, and reused while the db is unchanged.\n\n"
+         "Diff mode (writes officeregdb_diff.csv with changes between two dbs):\n"
+         "Read_OfficeRegDB.py diff <older db> <newer db> <output folder>\n\n"
+         "Batch mode (all dbs found under the image roots, processed in parallel):\n"
+         "Read_OfficeRegDB.py batch [-c] [-w <workers>] [-b <max inline bytes>] <output folder> <image root> [<image root> ..]\n"
+         " Output files are named after the source, -c puts all rows in one combined CSV.\n\n"
          "Requirements: Python (2 or 3), biplist and recent version of sqlite3\n"
          " biplist can be installed with a simple 'pip install biplist' command\n"
          " sqlite3 is there by default but may need to be updated if you get errors\n"
          " If it needs updating, follow instructions in the script header."
          )
 
-print ("Using Python %i.%i" % (sys.version_info.major, sys.version_info.minor) )
-PYTHON_VER = sys.version_info.major
+def main():
+    if len(sys.argv) > 1 and sys.argv[1].lower() == 'query': # No banner, output is the query result
+        args = sys.argv[2:]
+        indexPath = None
+        if len(args) > 1 and args[0] == '-i':
+            indexPath = args[1]
+            args = args[2:]
+        if len(args) == 3 and args[1].lower() in ('get', 'list', 'search'):
+            inputPath = args[0]
+            if os.path.exists(inputPath):
+                QueryRegistrationDBFile(inputPath, indexPath, args[1].lower(), args[2])
+            else:
+                print("Error: Failed to find file at specified path. Path was : " + inputPath)
+        else:
+            print("Wrong arguments for query..")
+            print(usage)
+        return
 
-if len(sys.argv) > 2:
-    inputPath = sys.argv[1]
-    outputPath = sys.argv[2]
-    try:
-        if os.path.exists(inputPath):
-            if os.path.isdir(outputPath): # Check output path provided
-                ParseRegistrationDBFile(inputPath, outputPath)
-            else: # Either path does not exist or it is not a folder
-                if os.path.isfile(outputPath):
-                    print("Error: There is already a file existing by that name. Cannot create folder : " + outputPath)
-                else: # Try creating folder
-                    try:
-                        os.makedirs(outputPath)
-                        ParseRegistrationDBFile(inputPath, outputPath)
-                    except Exception as ex:
-                        print("Error: Cannot create output folder : " + outputPath + "\nError Details: " + ex.args)
+    print ("Using Python %i.%i" % (sys.version_info.major, sys.version_info.minor) )
+    if len(sys.argv) > 1 and sys.argv[1].lower() == 'batch':
+        args = sys.argv[2:]
+        combined = False
+        workers = None
+        blobThreshold = None
+        try:
+            while args and args[0] in ('-c', '-w', '-b'):
+                if args[0] == '-c':
+                    combined = True
+                    args = args[1:]
+                elif args[0] == '-w':
+                    workers = int(args[1])
+                    args = args[2:]
+                else:
+                    blobThreshold = int(args[1])
+                    args = args[2:]
+        except (IndexError, ValueError):
+            print("Error: -w and -b need a number")
+            return
+        if len(args) < 2:
+            print("Wrong arguments for batch..")
+            print(usage)
+            return
+        outputPath, roots = args[0], args[1:]
+        for root in roots:
+            if not os.path.isdir(root):
+                print("Error: Image root is not a folder : " + root)
+                return
+        if not os.path.isdir(outputPath):
+            try:
+                os.makedirs(outputPath)
+            except OSError as ex:
+                print("Error: Cannot create output folder : " + outputPath + "\nError Details: " + str(ex))
+                return
+        ProcessRegistrationDBFilesInBatch(roots, outputPath, blobThreshold, combined, workers)
+    elif len(sys.argv) > 1 and sys.argv[1].lower() == 'diff':
+        if len(sys.argv) == 5:
+            oldPath, newPath, outputPath = sys.argv[2:5]
+            for path in (oldPath, newPath):
+                if not os.path.exists(path):
+                    print("Error: Failed to find file at specified path. Path was : " + path)
+                    return
+            if not os.path.isdir(outputPath):
+                try:
+                    os.makedirs(outputPath)
+                except OSError as ex:
+                    print("Error: Cannot create output folder : " + outputPath + "\nError Details: " + str(ex))
+                    return
+            DiffRegistrationDBFiles(oldPath, newPath, outputPath)
         else:
-            print("Error: Failed to find file at specified path. Path was : " + inputPath)
-    except Exception as ex:
-        print("Error: Unknown exception, error details are: " + ex.args)
-else:
-    print("Not enough arguments..")
-    print(usage)
+            print("Wrong arguments for diff..")
+            print(usage)
+    else:
+        args = sys.argv[1:]
+        blobThreshold = None
+        if len(args) > 1 and args[0] == '-b':
+            try:
+                blobThreshold = int(args[1])
+            except ValueError:
+                print("Error: -b needs a size in bytes, got : " + args[1])
+                return
+            args = args[2:]
+        if len(args) < 2:
+            print("Not enough arguments..")
+            print(usage)
+            return
+        inputPath = args[0]
+        outputPath = args[1]
+        try:
+            if os.path.exists(inputPath):
+                if os.path.isdir(outputPath): # Check output path provided
+                    ParseRegistrationDBFile(inputPath, outputPath, blobThreshold)
+                else: # Either path does not exist or it is not a folder
+                    if os.path.isfile(outputPath):
+                        print("Error: There is already a file existing by that name. Cannot create folder : " + outputPath)
+                    else: # Try creating folder
+                        try:
+                            os.makedirs(outputPath)
+                            ParseRegistrationDBFile(inputPath, outputPath, blobThreshold)
+                        except Exception as ex:
+                            print("Error: Cannot create output folder : " + outputPath + "\nError Details: " + ex.args)
+            else:
+                print("Error: Failed to find file at specified path. Path was : " + inputPath)
+        except Exception as ex:
+            print("Error: Unknown exception, error details are: " + ex.args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+#
+# Size limited cache folder, shared by ios_ktx2png and the Deserializer
+# Copyright (c) 2018-2024  Yogesh Khatri <yogesh@swiftforensics.com>
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You can get a copy of the complete license here:
+#  <http://www.gnu.org/licenses/>.
+#
+# Script Name  : cache_index.py
+# Author       : Yogesh Khatri
+# Purpose      : Objects (converted outputs) are stored in a cache folder as
+#                objects/<key[0:2]>/<key>, written directly by worker processes.
+#                CacheIndex keeps an sqlite index of them (index.db) from the
+#                main process, and evicts least recently used objects when the
+#                cache grows over its size limit.
+# Requirements : Python3
+#
+
+import os
+import sqlite3
+import time
+
+def get_cache_object_path(cache_folder, key):
+    return os.path.join(cache_folder, 'objects', key[0:2], key)
+
+class CacheIndex:
+    '''Index of the cache folder, used only from the main process. Workers add
+       objects to the folder, their results are recorded here, and least recently
+       used objects are evicted when the total size goes over max_size bytes.
+    '''
+    def __init__(self, cache_folder, max_size):
+        self.cache_folder = cache_folder
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        os.makedirs(os.path.join(cache_folder, 'objects'), exist_ok=True)
+        self.conn = sqlite3.connect(os.path.join(cache_folder, 'index.db'))
+        self.conn.execute('CREATE TABLE IF NOT EXISTS objects (key TEXT PRIMARY KEY, size INTEGER, last_used REAL)')
+        self.conn.execute('CREATE INDEX IF NOT EXISTS objects_last_used ON objects (last_used)')
+
+    def record(self, info):
+        '''Records a worker result, info is a dict with 'cache_key', 'cache_hit'
+           and 'size' (nothing is recorded if cache wasn't used for it)'''
+        if 'cache_hit' not in info:
+            return
+        if info['cache_hit']:
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.conn.execute('INSERT OR REPLACE INTO objects (key, size, last_used) VALUES (?,?,?)',
+                          (info['cache_key'], info['size'], time.time()))
+
+    def evict(self):
+        '''Deletes least recently used objects until cache is within max_size'''
+        total = self.conn.execute('SELECT TOTAL(size) FROM objects').fetchone()[0]
+        if total > self.max_size:
+            evicted = []
+            for key, size in self.conn.execute('SELECT key, size FROM objects ORDER BY last_used'):
+                if total <= self.max_size:
+                    break
+                try:
+                    os.remove(get_cache_object_path(self.cache_folder, key))
+                except OSError:
+                    pass
+                evicted.append((key,))
+                total -= size
+            self.conn.executemany('DELETE FROM objects WHERE key=?', evicted)
+
+    def close(self):
+        self.evict()
+        self.conn.commit()
+        self.conn.close()
@@ -22,57 +22,282 @@
 #                given a user's UUID and UID. These are the folders found
 #                under /var/folders/
 #
+#                To generate paths for many (uuid, uid) pairs, use 
+#                generate_many(), which is much faster than calling the
+#                functions below in a loop.
+#
+#                Folder names can also be decoded back to the UUID and UID
+#                with DecodeDarwinPath(). The index mode does this for all
+#                folders under /private/var/folders on a mounted image and 
+#                matches them to the local user accounts.
+#
+# Usage        : darwin_path_generator.py path <UUID> <UID>
+#                darwin_path_generator.py decode <FOLDER_PATH>
+#                darwin_path_generator.py index <IMAGE_ROOT> [OUTPUT.csv]
+#
 
 from __future__ import print_function
 import binascii
+import os
+import sys
+# csv and plistlib are imported in the index functions, which alone need them,
+# to keep the import of this module for path generation quick.
 
 
-def GetDarwinPath(uuid, uid):
-    '''Returns DARWIN_USER_FOLDER path constructed from UUID and UID for 
-       osx older than Mavericks(10.9)'''
-    charset ='+-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+OLD_CHARSET = '+-0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz'
+NEW_CHARSET = '0123456789_bcdfghjklmnpqrstvwxyz'
+
+def GetHexValue(uuid, uid):
+    '''Returns (value, number of bits) of the UUID and UID concatenated as hex'''
     uuid = uuid.replace('-', '') # strip '-' if present
     #Convert uid to hex 8 byte string
     uid = '{:08x}'.format(int(uid)) # input uid may be int or string (decimal)
     hex_string = uuid + uid
-    binary_string = ''.join('{0:04b}'.format(int(c, 16)) for c in hex_string) # get binary string
-    
-    size = len(binary_string)
-    darwin_path = ''
-    for x in range(0, size, 6):
-        index = binary_string[x:x+6]
-        darwin_path += charset[int(index, 2)]
-        if x == 6:
-            darwin_path += '/' + darwin_path
-    return darwin_path
+    if not hex_string.isalnum(): # int() would allow '_', spaces, sign
+        raise ValueError('invalid hex string ' + hex_string)
+    return int(hex_string, 16), 4 * len(hex_string)
+
+def EncodeBits(value, num_bits, bits_per_char, charset):
+    '''Returns list of chars, each encoding the next bits_per_char bits of value 
+       starting from its top bit. A last partial group is used as is (not padded).'''
+    chars = []
+    mask = (1 << bits_per_char) - 1
+    for x in range(0, num_bits - bits_per_char + 1, bits_per_char):
+        chars.append(charset[(value >> (num_bits - x - bits_per_char)) & mask])
+    remaining = num_bits % bits_per_char
+    if remaining:
+        chars.append(charset[value & ((1 << remaining) - 1)])
+    return chars
+
+def GetDarwinPath(uuid, uid):
+    '''Returns DARWIN_USER_FOLDER path constructed from UUID and UID for 
+       osx older than Mavericks(10.9)'''
+    value, num_bits = GetHexValue(uuid, uid)
+    chars = EncodeBits(value, num_bits, 6, OLD_CHARSET)
+    if len(chars) >= 2:
+        return ''.join(chars[0:2]) + '/' + ''.join(chars)
+    return ''.join(chars)
 
 def GetDarwinPath2(uuid, uid):
     '''Returns DARWIN_USER_FOLDER path constructed from UUID and UID.
        This is the algorithm for newer osx - Mavericks(10.9) thru Sierra(10.12)'''
-    charset ='0123456789_bcdfghjklmnpqrstvwxyz'
-    uuid = uuid.replace('-', '') # strip '-' if present
-    #Convert uid to hex 8 byte string
-    uid = '{:08x}'.format(int(uid)) # input uid may be int or string (decimal)
-    hex_string = uuid + uid
-    binary_string = ''.join('{0:04b}'.format(int(c, 16)) for c in hex_string) # get binary string
-    
-    size = len(binary_string)
-    darwin_path = ''
-    for x in range(0, size, 5):
-        index = binary_string[x:x+5]
-        darwin_path += charset[int(index, 2)]
-        if x == 5:
-            darwin_path += '/'
-    return darwin_path
-
-#print(GetDarwinPath2('3CEEF7A5-A3D9-47DC-82C1-8E386A1EA83B', 502))
-
-# Computing path for root user
-root_uuid='FFFFEEEEDDDDCCCCBBBBAAAA00000000'
-root_uid = 0
-
-path_on_older_mac = GetDarwinPath(root_uuid, root_uid)
-path_on_newer_mac = GetDarwinPath2(root_uuid, root_uid)
-
-print('Darwin folder path for root on older macs is /var/folders/' + path_on_older_mac)
-print('Darwin folder path for root on newer macs is /var/folders/' + path_on_newer_mac)
+    value, num_bits = GetHexValue(uuid, uid)
+    chars = EncodeBits(value, num_bits, 5, NEW_CHARSET)
+    if len(chars) >= 2:
+        return ''.join(chars[0:2]) + '/' + ''.join(chars[2:])
+    return ''.join(chars)
+
+# For generate_many(), the 160 bit value is split at char boundaries into a part
+# that only depends on the UUID, a part mixing the low UUID bits with the top of
+# the UID, and a part only from the low UID bits, which is looked up in a table.
+#   old scheme (6 bit chars):  bits 0-125 | 126-143 (2+16 bits) | 144-159 (6,6,4 bits)
+#   new scheme (5 bit chars):  bits 0-124 | 125-144 (3+17 bits) | 145-159 (5,5,5 bits)
+_low_tables = {}
+
+def _GetLowTable(scheme):
+    table = _low_tables.get(scheme)
+    if table is None:
+        if scheme == 'old':
+            c = OLD_CHARSET
+            table = [c[v >> 10] + c[(v >> 4) & 0x3F] + c[v & 0xF] for v in range(0x10000)]
+        else:
+            c = NEW_CHARSET
+            table = [c[v >> 10] + c[(v >> 5) & 0x1F] + c[v & 0x1F] for v in range(0x8000)]
+        _low_tables[scheme] = table
+    return table
+
+def generate_many(pairs, scheme='old'):
+    '''Generator yielding the DARWIN_USER_FOLDER path for each (uuid, uid) in pairs,
+       same as GetDarwinPath (scheme='old') or GetDarwinPath2 (scheme='new').
+       Work that only depends on the UUID is done once per UUID, so this is 
+       fastest for many UIDs per UUID, like a range of UIDs for a known UUID.'''
+    if scheme == 'old':
+        single_func, charset, uuid_bits, low_bits, high_chars, bits_per_char = GetDarwinPath, OLD_CHARSET, 2, 16, 3, 6
+    elif scheme == 'new':
+        single_func, charset, uuid_bits, low_bits, high_chars, bits_per_char = GetDarwinPath2, NEW_CHARSET, 3, 15, 4, 5
+    else:
+        raise ValueError('scheme must be old or new')
+    low_table = _GetLowTable(scheme)
+    low_mask = (1 << low_bits) - 1
+    high_mask = (1 << bits_per_char) - 1
+    high_shift = 32 - low_bits
+    last_uuid = None
+    for uuid, uid in pairs:
+        if uuid != last_uuid:
+            last_uuid = uuid
+            prefix = None
+            hex_uuid = uuid.replace('-', '')
+            if len(hex_uuid) == 32 and hex_uuid.isalnum():
+                uuid_value = int(hex_uuid, 16)
+                uuid_low = (uuid_value & ((1 << uuid_bits) - 1)) << high_shift
+                top = EncodeBits(uuid_value >> uuid_bits, 128 - uuid_bits, bits_per_char, charset)
+                if scheme == 'old':
+                    prefix = ''.join(top[0:2]) + '/' + ''.join(top)
+                else:
+                    prefix = ''.join(top[0:2]) + '/' + ''.join(top[2:])
+                high_parts = {}
+        uid = int(uid)
+        if prefix is None or not 0 <= uid <= 0xFFFFFFFF: # not the usual sizes
+            yield single_func(uuid, uid)
+            continue
+        high = uid >> low_bits
+        high_part = high_parts.get(high)
+        if high_part is None:
+            value = uuid_low | high
+            high_part = ''.join([charset[(value >> (bits_per_char * (high_chars - 1 - i))) & high_mask] 
+                                 for i in range(high_chars)])
+            high_parts[high] = high_part
+        yield prefix + high_part + low_table[uid & low_mask]
+
+OLD_CHARSET_INDEX = dict((c, i) for i, c in enumerate(OLD_CHARSET))
+NEW_CHARSET_INDEX = dict((c, i) for i, c in enumerate(NEW_CHARSET))
+
+def FormatUuid(value):
+    '''Returns 128 bit value as uppercase UUID string, as found in user records'''
+    h = '{:032X}'.format(value)
+    return '-'.join((h[0:8], h[8:12], h[12:16], h[16:20], h[20:32]))
+
+def DecodeDarwinPath(path):
+    '''Returns (uuid, uid, scheme) from a DARWIN_USER_FOLDER path, which may be a full 
+       path like /private/var/folders/xx/yyyyy/T or just xx/yyyyy. Scheme is 'old' or
+       'new' (see GetDarwinPath, GetDarwinPath2). Returns None if path is not one.'''
+    parts = [x for x in path.replace('\\', '/').split('/') if x]
+    # The last var/folders pair, as the image root may itself be under a 'folders' folder
+    pos = None
+    for index in range(len(parts) - 1):
+        if parts[index].lower() == 'var' and parts[index + 1].lower() == 'folders':
+            pos = index + 2
+    if pos is None:
+        parts = parts[-2:]
+    else:
+        parts = parts[pos : pos + 2]
+    if len(parts) != 2 or len(parts[0]) != 2:
+        return None
+    first, second = parts
+    value = 0
+    if len(second) == 30: # new scheme, 32 chars of 5 bits
+        try:
+            for c in first + second:
+                value = (value << 5) | NEW_CHARSET_INDEX[c]
+        except KeyError:
+            return None
+        scheme = 'new'
+    elif len(second) == 27 and second.startswith(first): # old scheme, 26 chars of 6 bits + 4 bits
+        try:
+            for c in second[:-1]:
+                value = (value << 6) | OLD_CHARSET_INDEX[c]
+            last = OLD_CHARSET_INDEX[second[-1]]
+        except KeyError:
+            return None
+        if last > 0xF:
+            return None
+        value = (value << 4) | last
+        scheme = 'old'
+    else:
+        return None
+    return FormatUuid(value >> 32), value & 0xFFFFFFFF, scheme
+
+def ReadPlist(path):
+    import plistlib
+    with open(path, 'rb') as f:
+        if hasattr(plistlib, 'load'):
+            return plistlib.load(f)
+        return plistlib.readPlist(f) # python 2, xml only
+
+def GetUserRecords(root):
+    '''Returns dict of uppercase UUID -> (name, uid, home) from the local user 
+       plists under root (mounted image or live system /)'''
+    users = {}
+    users_folder = os.path.join(root, 'private', 'var', 'db', 'dslocal', 'nodes', 'Default', 'users')
+    if not os.path.isdir(users_folder):
+        print('Could not find user records at ' + users_folder)
+        return users
+    for name in sorted(os.listdir(users_folder)):
+        if not name.endswith('.plist'):
+            continue
+        try:
+            plist = ReadPlist(os.path.join(users_folder, name))
+        except Exception as ex:
+            print('Failed to read {}, error was {}'.format(name, str(ex)))
+            continue
+        first = lambda key: plist.get(key, [''])[0] if plist.get(key) else ''
+        uuid = first('generateduid')
+        if uuid:
+            users[uuid.upper()] = (first('name'), first('uid'), first('home'))
+    return users
+
+def IndexDarwinFolders(root, output_file):
+    '''Decodes all /private/var/folders/xx/yyyy (or /var/folders/..) names under root 
+       and writes them, matched to user records, as CSV to output_file (an open file). 
+       Returns number of folders found.'''
+    import csv
+    users = GetUserRecords(root)
+    folders_path = os.path.join(root, 'private', 'var', 'folders')
+    prefix = '/private/var/folders/'
+    if not os.path.isdir(folders_path):
+        folders_path = os.path.join(root, 'var', 'folders')
+        prefix = '/var/folders/'
+    writer = csv.writer(output_file)
+    writer.writerow(['Folder', 'Scheme', 'UUID', 'UID', 'User', 'UserUID', 'Home'])
+    count = 0
+    try:
+        first_level = sorted(os.listdir(folders_path))
+    except OSError as ex:
+        print('Could not list {}, error was {}'.format(folders_path, str(ex)))
+        return 0
+    for first in first_level:
+        first_path = os.path.join(folders_path, first)
+        if not os.path.isdir(first_path):
+            continue
+        for second in sorted(os.listdir(first_path)):
+            count += 1
+            decoded = DecodeDarwinPath(first + '/' + second)
+            if decoded is None:
+                writer.writerow([prefix + first + '/' + second, '', '', '', '', '', ''])
+                continue
+            uuid, uid, scheme = decoded
+            user = users.get(uuid, ('', '', ''))
+            writer.writerow([prefix + first + '/' + second, scheme, uuid, uid] + list(user))
+    return count
+
+def main():
+    usage = 'Usage: darwin_path_generator.py path <UUID> <UID>\n' \
+            '       darwin_path_generator.py decode <FOLDER_PATH>\n' \
+            '       darwin_path_generator.py index <IMAGE_ROOT> [OUTPUT.csv]\n' \
+            'With no arguments, paths for the root user are shown.'
+    args = sys.argv[1:]
+    if not args:
+        # Computing path for root user
+        root_uuid='FFFFEEEEDDDDCCCCBBBBAAAA00000000'
+        root_uid = 0
+
+        path_on_older_mac = GetDarwinPath(root_uuid, root_uid)
+        path_on_newer_mac = GetDarwinPath2(root_uuid, root_uid)
+
+        print('Darwin folder path for root on older macs is /var/folders/' + path_on_older_mac)
+        print('Darwin folder path for root on newer macs is /var/folders/' + path_on_newer_mac)
+    elif args[0] == 'path' and len(args) == 3:
+        print('Darwin folder path on older macs is /var/folders/' + GetDarwinPath(args[1], args[2]))
+        print('Darwin folder path on newer macs is /var/folders/' + GetDarwinPath2(args[1], args[2]))
+    elif args[0] == 'decode' and len(args) == 2:
+        decoded = DecodeDarwinPath(args[1])
+        if decoded is None:
+            print('Not a DARWIN_USER_FOLDER path - ' + args[1])
+        else:
+            print('UUID={} UID={} ({} scheme)'.format(*decoded))
+    elif args[0] == 'index' and len(args) in (2, 3):
+        if len(args) == 3:
+            if sys.version_info.major >= 3:
+                output_file = open(args[2], 'w', newline='')
+            else:
+                output_file = open(args[2], 'wb')
+            with output_file:
+                count = IndexDarwinFolders(args[1], output_file)
+            print('Found {} folders. Output is at {}'.format(count, args[2]))
+        else:
+            IndexDarwinFolders(args[1], sys.stdout)
+    else:
+        print(usage)
+
+if __name__ == "__main__":
+    main()
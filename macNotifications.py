@@ -50,9 +50,9 @@ import sqlite3
 import sys
 import os
 import uuid
-import biplist
 import datetime
-from biplist import *
+# biplist is imported when a database is processed, so importing this module
+# to use its functions is quick and has no dependencies beyond python.
 
 def RemoveTabsNewLines(str):
     try:
@@ -95,6 +95,7 @@ def GetDbVersion(conn):
 
 def Parse_ver_17_Db(conn, inputPath, outputPath):
     '''Parse High Sierra's notification db'''
+    from biplist import readPlistFromString, InvalidPlistException, NotBinaryPlistException
     try:
         conn.row_factory = sqlite3.Row
         cursor = conn.execute("SELECT (SELECT identifier from app where app.app_id=record.app_id) as app, "\
@@ -133,6 +134,7 @@ def Parse_ver_17_Db(conn, inputPath, outputPath):
         print ("Sqlite error - \nError details: \n" + str(ex))
 
 def ProcessNotificationDb(inputPath, outputPath):
+    from biplist import readPlistFromString, InvalidPlistException, NotBinaryPlistException
     try:
         conn = sqlite3.connect(inputPath)
         print ("Opened database successfully");
@@ -216,18 +218,22 @@ usage = ("macNotifications.py - Parse the OSX Notifications database \n\n"
          " biplist can be installed with a simple 'pip install biplist' command"
          )
          
-print ("Using Python %i.%i" % (sys.version_info.major, sys.version_info.minor) )
-if len(sys.argv) > 2:
-    inputPath = sys.argv[1]
-    outputPath = sys.argv[2]
-    try:
-        if os.path.exists(inputPath):
-            ProcessNotificationDb(inputPath, outputPath)
+def main():
+    print ("Using Python %i.%i" % (sys.version_info.major, sys.version_info.minor) )
+    if len(sys.argv) > 2:
+        inputPath = sys.argv[1]
+        outputPath = sys.argv[2]
+        try:
+            if os.path.exists(inputPath):
+                ProcessNotificationDb(inputPath, outputPath)
 
-        else:
-            print("Error: Failed to find file at specified path. Path was : " + inputPath)
-    except Exception as ex:
-        print("Error: Unknown exception, error details are: " + ex.args)
-else:
-    print("Not enough arguments..")
-    print(usage)
+            else:
+                print("Error: Failed to find file at specified path. Path was : " + inputPath)
+        except Exception as ex:
+            print("Error: Unknown exception, error details are: " + str(ex))
+    else:
+        print("Not enough arguments..")
+        print(usage)
+
+if __name__ == "__main__":
+    main()
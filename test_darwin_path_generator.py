@@ -0,0 +1,157 @@
+#
+# Tests for darwin_path_generator.py
+# Run with:  python -m unittest test_darwin_path_generator
+#
+
+import io
+import os
+import random
+import shutil
+import tempfile
+import unittest
+
+import darwin_path_generator as dpg
+
+UID_BOUNDS = (0, 1, 501, 0x7FFF, 0x8000, 0xFFFF, 0x10000, 0x7FFFFFFF, 0x80000000, 0xFFFFFFFF)
+UUID_BOUNDS = ('00000000-0000-0000-0000-000000000000', 'FFFFFFFF-FFFF-FFFF-FFFF-FFFFFFFFFFFF',
+               '80000000-0000-0000-0000-000000000001', 'FFFFEEEEDDDDCCCCBBBBAAAA00000000')
+
+def ReferenceDarwinPath(uuid, uid, bits_per_char, charset, old_style):
+    '''The original bit string implementation, which the optimized encoders must match'''
+    hex_string = uuid.replace('-', '') + '{:08x}'.format(int(uid))
+    binary_string = ''.join('{0:04b}'.format(int(c, 16)) for c in hex_string)
+    darwin_path = ''
+    for x in range(0, len(binary_string), bits_per_char):
+        darwin_path += charset[int(binary_string[x:x + bits_per_char], 2)]
+        if x == bits_per_char:
+            darwin_path += '/' + darwin_path if old_style else '/'
+    return darwin_path
+
+def ReferenceOld(uuid, uid):
+    return ReferenceDarwinPath(uuid, uid, 6, dpg.OLD_CHARSET, True)
+
+def ReferenceNew(uuid, uid):
+    return ReferenceDarwinPath(uuid, uid, 5, dpg.NEW_CHARSET, False)
+
+def RandomUuid(rng):
+    return dpg.FormatUuid(rng.getrandbits(128))
+
+class DarwinPathTests(unittest.TestCase):
+
+    def setUp(self):
+        self.rng = random.Random(1017)
+        self.uuids = list(UUID_BOUNDS) + [RandomUuid(self.rng) for _ in range(50)]
+        self.uids = list(UID_BOUNDS) + [self.rng.getrandbits(32) for _ in range(50)]
+
+    def Pairs(self):
+        return [(uuid, uid) for uuid in self.uuids for uid in self.uids]
+
+    def test_matches_reference(self):
+        for uuid, uid in self.Pairs():
+            self.assertEqual(dpg.GetDarwinPath(uuid, uid), ReferenceOld(uuid, uid))
+            self.assertEqual(dpg.GetDarwinPath2(uuid, uid), ReferenceNew(uuid, uid))
+
+    def test_path_lengths(self):
+        # 160 bits is 26 chars of 6 bits plus a last one of 4 bits, or exactly 32 chars of 5 bits
+        for uuid, uid in self.Pairs():
+            first, second = dpg.GetDarwinPath(uuid, uid).split('/')
+            self.assertEqual((len(first), len(second)), (2, 27))
+            self.assertTrue(second.startswith(first))
+            self.assertIn(second[-1], dpg.OLD_CHARSET[:16])
+            first, second = dpg.GetDarwinPath2(uuid, uid).split('/')
+            self.assertEqual((len(first), len(second)), (2, 30))
+
+    def test_uid_as_string(self):
+        for uid in UID_BOUNDS:
+            self.assertEqual(dpg.GetDarwinPath(UUID_BOUNDS[2], str(uid)), dpg.GetDarwinPath(UUID_BOUNDS[2], uid))
+            self.assertEqual(dpg.GetDarwinPath2(UUID_BOUNDS[2], str(uid)), dpg.GetDarwinPath2(UUID_BOUNDS[2], uid))
+
+    def test_partial_last_char_not_padded(self):
+        # uids over 32 bits make a longer hex string, its last partial group is used as is
+        for uid in (0x100000000, 0xFFFFFFFFF, 0x123456789A):
+            self.assertEqual(dpg.GetDarwinPath(UUID_BOUNDS[1], uid), ReferenceOld(UUID_BOUNDS[1], uid))
+            self.assertEqual(dpg.GetDarwinPath2(UUID_BOUNDS[1], uid), ReferenceNew(UUID_BOUNDS[1], uid))
+        for num_bits in range(1, 40):
+            value = self.rng.getrandbits(num_bits)
+            for bits_per_char, charset in ((6, dpg.OLD_CHARSET), (5, dpg.NEW_CHARSET)):
+                chars = dpg.EncodeBits(value, num_bits, bits_per_char, charset)
+                full, remaining = divmod(num_bits, bits_per_char)
+                self.assertEqual(len(chars), full + (1 if remaining else 0))
+                decoded = 0
+                for c in chars[:full]:
+                    decoded = (decoded << bits_per_char) | charset.index(c)
+                if remaining:
+                    decoded = (decoded << remaining) | charset.index(chars[-1])
+                self.assertEqual(decoded, value)
+
+    def test_invalid_input(self):
+        for uuid, uid in (('3CEEF7A5-A3D9-47DC-82C1-8E386A1EA8_B', 501), ('3CEEF7A5 A3D9', 501),
+                          ('3CEEF7A5-A3D9-47DC-82C1-8E386A1EA83B', -1)):
+            self.assertRaises(ValueError, dpg.GetDarwinPath, uuid, uid)
+            self.assertRaises(ValueError, dpg.GetDarwinPath2, uuid, uid)
+
+    def test_generate_many_matches_single(self):
+        pairs = self.Pairs()
+        pairs += [(UUID_BOUNDS[0], 0x100000000), ('ABCDEF', 501), (UUID_BOUNDS[0], 501)]
+        self.rng.shuffle(pairs)
+        pairs += sorted(pairs) # runs of the same uuid, as well as changing ones
+        self.assertEqual(list(dpg.generate_many(pairs, 'old')), [dpg.GetDarwinPath(u, i) for u, i in pairs])
+        self.assertEqual(list(dpg.generate_many(pairs, 'new')), [dpg.GetDarwinPath2(u, i) for u, i in pairs])
+        self.assertRaises(ValueError, list, dpg.generate_many(pairs, 'other'))
+
+    def test_decode_round_trip(self):
+        for uuid, uid in self.Pairs():
+            expected_uuid = dpg.FormatUuid(int(uuid.replace('-', ''), 16))
+            self.assertEqual(dpg.DecodeDarwinPath(dpg.GetDarwinPath(uuid, uid)), (expected_uuid, uid, 'old'))
+            self.assertEqual(dpg.DecodeDarwinPath(dpg.GetDarwinPath2(uuid, uid)), (expected_uuid, uid, 'new'))
+
+    def test_decode_full_paths(self):
+        uuid, uid = '3CEEF7A5-A3D9-47DC-82C1-8E386A1EA83B', 502
+        path = dpg.GetDarwinPath2(uuid, uid)
+        for full_path in ('/private/var/folders/' + path + '/T', '/var/folders/' + path,
+                          'C:\\img\\private\\var\\folders\\' + path.replace('/', '\\') + '\\C\\'):
+            self.assertEqual(dpg.DecodeDarwinPath(full_path), (uuid, uid, 'new'))
+
+    def test_decode_image_under_folders_folder(self):
+        uuid, uid = '3CEEF7A5-A3D9-47DC-82C1-8E386A1EA83B', 502
+        path = dpg.GetDarwinPath2(uuid, uid)
+        other = dpg.GetDarwinPath2(UUID_BOUNDS[2], 501)
+        for full_path in ('/cases/folders/' + other + '/img/private/var/folders/' + path + '/T',
+                          '/cases/var/folders/' + other + '/img/private/var/folders/' + path,
+                          'E:\\Folders\\img\\VAR\\FOLDERS\\' + path.replace('/', '\\')):
+            self.assertEqual(dpg.DecodeDarwinPath(full_path), (uuid, uid, 'new'))
+
+    def test_decode_rejects_other_folders(self):
+        new_path = dpg.GetDarwinPath2(UUID_BOUNDS[2], 501)
+        old_path = dpg.GetDarwinPath(UUID_BOUNDS[2], 501)
+        for path in ('', 'zz', '/private/var/folders/zz', new_path[:-1], new_path + 'b',
+                     'a' + new_path[1:], old_path[:-1] + 'z', # last old char only has 4 bits
+                     old_path.replace('/', '/X', 1), '/private/var/folders/' + old_path[:3] + '*' + old_path[4:]):
+            self.assertIsNone(dpg.DecodeDarwinPath(path), path)
+
+class IndexTests(unittest.TestCase):
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def Index(self, *folders_parts):
+        path = dpg.GetDarwinPath2(UUID_BOUNDS[2], 501)
+        os.makedirs(os.path.join(self.root, *(folders_parts + tuple(path.split('/')))))
+        output = io.BytesIO() if str is bytes else io.StringIO()
+        self.assertEqual(dpg.IndexDarwinFolders(self.root, output), 1)
+        rows = output.getvalue().splitlines()
+        return rows[1].split(',')[0], '/' + '/'.join(folders_parts) + '/' + path
+
+    def test_index_private_var_folders(self):
+        folder, expected = self.Index('private', 'var', 'folders')
+        self.assertEqual(folder, expected)
+
+    def test_index_var_folders(self):
+        folder, expected = self.Index('var', 'folders')
+        self.assertEqual(folder, expected)
+
+if __name__ == '__main__':
+    unittest.main()